@@ -1,9 +1,24 @@
 from apf.core.step import GenericStep
 from apf.producers import KafkaProducer
 
-from ingestion_step.utils.multi_driver.connection import MultiDriverConnection
+from ingestion_step.utils.multi_driver.async_connection import (
+    AsyncMultiDriverConnection,
+)
+from ingestion_step.utils.multi_driver.connection import (
+    MultiDriverConnection,
+    psql_pool_capacity,
+    psql_read_connections,
+)
 
-from .utils.constants import DET_KEYS, OBJ_KEYS, NON_DET_KEYS, OLD_DET_KEYS
+from .utils.constants import (
+    DET_KEYS,
+    OBJ_KEYS,
+    OBJ_SUM_KEYS,
+    NON_DET_KEYS,
+    OLD_DET_KEYS,
+)
+from .utils.prv_candidates.cache import PrvCandidatesCache
+from .utils.write_behind import WriteBehindBuffer
 from .utils.prv_candidates.processor import Processor
 from .utils.prv_candidates.strategies import (
     ATLASPrvCandidatesStrategy,
@@ -15,6 +30,7 @@ from .utils.correction.strategies import (
     ZTFCorrectionStrategy,
 )
 from .utils.old_preprocess import (
+    PSQL_CATALOGS,
     get_catalog,
     preprocess_dataquality,
     insert_dataquality,
@@ -32,12 +48,15 @@ from .utils.old_preprocess import (
     compute_dmdt,
     preprocess_objects_,
 )
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, List
 
+import asyncio
 import numpy as np
 import pandas as pd
 import logging
 import sys
+import time
 
 sys.path.insert(0, "../../../../")
 pd.options.mode.chained_assignment = None
@@ -56,6 +75,94 @@ def parse_metadata(df: pd.DataFrame, name) -> pd.DataFrame:
     return new_df
 
 
+def isin_rows(
+    data: pd.DataFrame, other: pd.DataFrame, keys: List[str]
+) -> np.ndarray:
+    """Mask of the rows of data whose keys are in some row of other.
+
+    Same as `isin` between MultiIndex of the keys, but rows are compared as
+    uint64 hashes of integer keys. Integer columns are used as they are,
+    the rest are factorized over both frames.
+    """
+    data_keys, other_keys = {}, {}
+    for key in keys:
+        values, other_values = data[key].values, other[key].values
+        if (
+            values.dtype.kind not in "iu"
+            or other_values.dtype.kind not in "iu"
+        ):
+            codes, _ = pd.factorize(np.concatenate([values, other_values]))
+            values, other_values = codes[: len(values)], codes[len(values) :]
+        data_keys[key] = values.astype(np.int64)
+        other_keys[key] = other_values.astype(np.int64)
+    data_hashes = pd.util.hash_pandas_object(
+        pd.DataFrame(data_keys), index=False
+    ).values
+    other_hashes = pd.util.hash_pandas_object(
+        pd.DataFrame(other_keys), index=False
+    ).values
+    return np.isin(data_hashes, other_hashes)
+
+
+def mjd_key(mjd: pd.Series) -> np.ndarray:
+    """Integer mjd in units of 1e-5 days (same as rounding to 5 decimals)."""
+    return np.rint(mjd.values.astype(float) * 1e5).astype(np.int64)
+
+
+# Keys of Mongo objects read to update their stats. Objects are stored with
+# their aid as `_id`
+STORED_OBJ_KEYS = (
+    ["_id"] + [k for k in OBJ_KEYS if k != "aid"] + ["ndet"] + OBJ_SUM_KEYS
+)
+
+
+def select_rows(frame: pd.DataFrame, mask) -> pd.DataFrame:
+    """Rows of the frame in the mask, indexed from 0.
+
+    If every row is selected and the frame is already indexed from 0, the
+    frame itself is returned instead of a copy.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.all() and frame.index.equals(pd.RangeIndex(len(frame))):
+        return frame
+    selected = frame[mask]
+    selected.index = pd.RangeIndex(len(selected))
+    return selected
+
+
+ID_COLUMNS = ["aid", "oid", "tid", "fid"]
+
+
+def categorize_ids(frames: List[pd.DataFrame], columns=ID_COLUMNS) -> None:
+    """Convert id columns of the frames to categoricals, in place.
+
+    All frames get the same categories, so they can be concatenated and
+    joined without going back to object dtype.
+    """
+    for column in columns:
+        with_column = [frame for frame in frames if column in frame.columns]
+        if not with_column:
+            continue
+        values = np.concatenate(
+            [np.asarray(frame[column].values) for frame in with_column]
+        )
+        categories = pd.unique(values[pd.notnull(values)])
+        for frame in with_column:
+            frame[column] = pd.Categorical(
+                frame[column].values, categories=categories
+            )
+
+
+def restore_ids(frames: List[pd.DataFrame], columns=ID_COLUMNS) -> None:
+    """Convert categorical id columns of the frames back, in place."""
+    for frame in frames:
+        for column in columns:
+            if column in frame.columns and isinstance(
+                frame[column].dtype, pd.CategoricalDtype
+            ):
+                frame[column] = np.asarray(frame[column].values)
+
+
 class IngestionStep(GenericStep):
     """IngestionStep Description
 
@@ -79,8 +186,13 @@ class IngestionStep(GenericStep):
     ):
         super().__init__(consumer, config=config, level=level)
         self.version = config["STEP_METADATA"]["STEP_VERSION"]
+        # Latest jd ingested of each oid, shared between batches
+        cache_size = config.get("PRV_CANDIDATES_CACHE_SIZE")
+        self.prv_candidates_cache = (
+            PrvCandidatesCache(cache_size) if cache_size else None
+        )
         self.prv_candidates_processor = Processor(
-            ZTFPrvCandidatesStrategy()
+            ZTFPrvCandidatesStrategy(cache=self.prv_candidates_cache)
         )  # initial strategy (can change)
         self.detections_corrector = Corrector(
             ZTFCorrectionStrategy()
@@ -93,6 +205,73 @@ class IngestionStep(GenericStep):
             config["DB_CONFIG"]
         )
         self.driver.connect()
+        # Run PSQL and Mongo branches in parallel threads (both are I/O bound)
+        self.concurrent_execution = config.get("CONCURRENT_EXECUTION", False)
+        # Update stored object stats with new detections only (Mongo)
+        self.incremental_object_stats = config.get(
+            "INCREMENTAL_OBJECT_STATS", False
+        )
+        # Reuse stored magstats of (oid, fid) without new detections
+        self.incremental_magstats = config.get("INCREMENTAL_MAGSTATS", False)
+        # Use categorical ids while processing prv candidates and correction
+        self.categorical_ids = config.get("CATEGORICAL_IDS", False)
+        # Produce only the newest alert of each aid in a batch
+        self.unique_aid_messages = config.get("UNIQUE_AID_MESSAGES", False)
+        # Max number of concurrent reads on PSQL prefetch (None: one per read)
+        self.prefetch_workers = config.get("PSQL_PREFETCH_WORKERS")
+        # Documents fetched on each round trip of Mongo light curve reads
+        self.mongo_batch_size = config.get("MONGO_BATCH_SIZE")
+        # Overlap reads and writes of each batch in an event loop
+        self.async_execution = config.get("ASYNC_EXECUTION", False)
+        if self.async_execution:
+            self.loop = asyncio.new_event_loop()
+            self.async_driver = step_args.get(
+                "async_db_connection"
+            ) or AsyncMultiDriverConnection(config["DB_CONFIG"])
+            self.loop.run_until_complete(self.async_driver.connect())
+        # Buffer detections and non detections inserts across batches
+        self.write_buffer = None
+        write_behind = config.get("WRITE_BEHIND")
+        if write_behind:
+            self.write_buffer = WriteBehindBuffer(
+                self.write_buffered,
+                max_rows=write_behind.get("MAX_ROWS", 10000),
+                max_age=write_behind.get("MAX_AGE", 5.0),
+                queue_size=write_behind.get("QUEUE_SIZE", 100),
+            )
+            # Offsets are committed by the step, after flushing the buffer
+            self.commit = False
+            self.last_commit = time.monotonic()
+        # Prefetch reads run at once only as long as the PSQL pool has a
+        # connection for each of their chunk workers, besides the ones of
+        # the step's session and the write-behind thread
+        reserved = 1 if self.write_buffer is None else 2
+        self.max_prefetch_workers = max(
+            1,
+            (psql_pool_capacity(config["DB_CONFIG"]) - reserved)
+            // psql_read_connections(config["DB_CONFIG"]),
+        )
+
+    def start(self):
+        try:
+            super().start()
+        finally:
+            self.tear_down()
+
+    def tear_down(self):
+        """Release the resources of the step when it stops.
+
+        Buffered rows are written before their offsets are committed, a
+        failed write is raised instead. It can be called more than once.
+        """
+        try:
+            if self.write_buffer is not None:
+                self.write_buffer.close()
+                self.consumer.commit()
+        finally:
+            if self.async_execution and not self.loop.is_closed():
+                self.loop.run_until_complete(self.async_driver.close())
+                self.loop.close()
 
     def get_objects(self, aids: List[str or int], engine="mongo"):
         """
@@ -105,13 +284,8 @@ class IngestionStep(GenericStep):
         -------
 
         """
-        filter_by = {"aid": {"$in": aids}}
-        objects = self.driver.query("Object", engine=engine).find_all(
-            filter_by=filter_by, paginate=False
-        )
-        if len(objects) == 0 or engine == "mongo":
-            return pd.DataFrame(objects, columns=OBJ_KEYS)
-        return pd.DataFrame(objects)
+        objects = self._find_by_aids("Object", aids, OBJ_KEYS, engine)
+        return self._to_frame(objects, OBJ_KEYS, engine)
 
     def get_detections(self, aids: List[str or int], engine="mongo"):
         """
@@ -124,13 +298,8 @@ class IngestionStep(GenericStep):
         -------
 
         """
-        filter_by = {"aid": {"$in": aids}}
-        detections = self.driver.query("Detection", engine=engine).find_all(
-            filter_by=filter_by, paginate=False
-        )
-        if len(detections) == 0 or engine == "mongo":
-            return pd.DataFrame(detections, columns=DET_KEYS)
-        return pd.DataFrame(detections)
+        detections = self._find_by_aids("Detection", aids, DET_KEYS, engine)
+        return self._to_frame(detections, DET_KEYS, engine)
 
     def get_non_detections(self, aids: List[str or int], engine="mongo"):
         """
@@ -143,30 +312,91 @@ class IngestionStep(GenericStep):
         -------
 
         """
-        filter_by = {"aid": {"$in": aids}}
-        non_detections = self.driver.query(
-            "NonDetection", engine=engine
-        ).find_all(filter_by=filter_by, paginate=False)
-        if len(non_detections) == 0 or engine == "mongo":
-            return pd.DataFrame(non_detections, columns=NON_DET_KEYS)
-        return pd.DataFrame(non_detections)
+        non_detections = self._find_by_aids(
+            "NonDetection", aids, NON_DET_KEYS, engine
+        )
+        return self._to_frame(non_detections, NON_DET_KEYS, engine)
 
-    def insert_objects(self, objects: pd.DataFrame, engine="mongo") -> None:
+    def _find_by_aids(
+        self,
+        model: str,
+        aids: List[str or int],
+        columns: List[str],
+        engine,
+        key: str = "aid",
+    ):
+        # PSQL tables don't share the generic keys, so they are read whole
+        query = self.driver.query(model, engine=engine)
+        filter_by = {key: {"$in": aids}}
+        if engine == "mongo":
+            return query.find_dataframe(
+                filter_by=filter_by,
+                columns=columns,
+                batch_size=self.mongo_batch_size,
+            )
+        return query.find_dataframe(filter_by=filter_by)
+
+    def get_stored_objects(self, aids: List[str or int]) -> pd.DataFrame:
+        """Objects on Mongo with the stats needed to update them.
+
+        Parameters
+        ----------
+        aids: List of aids, stored as `_id` of the objects
+
+        Returns A DataFrame with STORED_OBJ_KEYS, where `_id` is named aid
+        -------
+
+        """
+        objects = self._find_by_aids(
+            "Object", aids, STORED_OBJ_KEYS, "mongo", key="_id"
+        )
+        return self._stored_objects_frame(objects)
+
+    @classmethod
+    def _stored_objects_frame(cls, data) -> pd.DataFrame:
+        frame = cls._to_frame(data, STORED_OBJ_KEYS, "mongo")
+        return frame.rename(columns={"_id": "aid"})
+
+    @staticmethod
+    def _to_frame(data, columns: List[str], engine) -> pd.DataFrame:
+        # PSQL rows keep all the columns of their table
+        if len(data) == 0 or engine == "mongo":
+            return pd.DataFrame(data, columns=columns)
+        return pd.DataFrame(data)
+
+    def insert_objects(
+        self, objects: pd.DataFrame, engine="mongo", driver=None
+    ):
         """
         Insert or update records in database. Insert new objects. Update old objects.
 
+        On mongo objects are upserted by aid, so it doesn't matter whether
+        they already exist. Their sums (OBJ_SUM_KEYS) are stored too, to
+        update their stats later (see `update_objects_stats`).
+
         Parameters
         ----------
         objects: Dataframe of astronomical objects.
         engine
+        driver: Connection used on mongo instead of the step one. With an
+            async connection the write is returned to be awaited.
         Returns
         -------
 
         """
         if engine == "mongo":
-            objects.drop_duplicates(["aid"], inplace=True)
-        else:
-            objects.drop_duplicates(["oid"], inplace=True)
+            driver = driver or self.driver
+            objects = objects.drop_duplicates(["aid"])
+            objects = objects.drop(columns=["new"], errors="ignore")
+            self.logger.info(f"Upserting {len(objects)} object(s)")
+            objects = objects.replace({np.nan: None})
+            dict_objects = objects.to_dict("records")
+            filters = [{"_id": obj["aid"]} for obj in dict_objects]
+            return driver.query("Object", engine=engine).bulk_upsert(
+                dict_objects, filter_by=filters, raw_fields=OBJ_SUM_KEYS
+            )
+
+        objects.drop_duplicates(["oid"], inplace=True)
         new_objects = objects["new"]
         objects.drop(columns=["new"], inplace=True)
 
@@ -176,8 +406,6 @@ class IngestionStep(GenericStep):
             f"Inserting {len(to_insert)} and updating {len(to_update)} object(s)"
         )
         if len(to_insert) > 0:
-            if engine == "mongo":
-                to_insert["_id"] = to_insert["aid"].values
             to_insert.replace({np.nan: None}, inplace=True)
             dict_to_insert = to_insert.to_dict("records")
             self.driver.query("Object", engine=engine).bulk_insert(
@@ -188,38 +416,57 @@ class IngestionStep(GenericStep):
         if len(to_update) > 0:
             to_update.replace({np.nan: None}, inplace=True)
             dict_to_update = to_update.to_dict("records")
-            filters = []
-            for obj in dict_to_update:
-                if engine == "mongo":
-                    filters.append({"_id": obj["aid"]})
-                else:
-                    filters.append({"_id": obj["oid"]})
+            filters = [{"_id": obj["oid"]} for obj in dict_to_update]
             self.driver.query("Object", engine=engine).bulk_update(
                 dict_to_update, filter_by=filters
             )
 
-    def insert_detections(self, detections: pd.DataFrame, engine="mongo"):
+    def insert_detections(
+        self,
+        detections: pd.DataFrame,
+        engine="mongo",
+        driver=None,
+        write_behind=True,
+    ):
         """
 
         Parameters
         ----------
         detections
         engine
+        driver: Connection used on mongo instead of the step one
+        write_behind: If False, write now even if there is a write buffer
         Returns
         -------
 
         """
+        if write_behind and self.write_buffer is not None:
+            key = "aid" if engine == "mongo" else "oid"
+            return self.write_buffer.put(
+                ("Detection", engine), detections, detections[key].unique()
+            )
         self.logger.info(
             f"Inserting {len(detections)} new detections {engine}"
         )
+        if engine == "psql":
+            # Skip rows already stored (e.g. when a batch is reprocessed)
+            self.driver.query("Detection", engine=engine).bulk_copy(
+                detections, staging=True
+            )
+            return
         detections = detections.where(detections.notnull(), None)
         dict_detections = detections.to_dict("records")
-        self.driver.query("Detection", engine=engine).bulk_insert(
+        driver = driver or self.driver
+        return driver.query("Detection", engine=engine).bulk_insert(
             dict_detections
         )
 
     def insert_non_detections(
-        self, non_detections: pd.DataFrame, engine="mongo"
+        self,
+        non_detections: pd.DataFrame,
+        engine="mongo",
+        driver=None,
+        write_behind=True,
     ):
         """
 
@@ -227,19 +474,60 @@ class IngestionStep(GenericStep):
         ----------
         non_detections
         engine
+        driver: Connection used on mongo instead of the step one
+        write_behind: If False, write now even if there is a write buffer
         Returns
         -------
 
         """
+        if write_behind and self.write_buffer is not None:
+            key = "aid" if engine == "mongo" else "oid"
+            return self.write_buffer.put(
+                ("NonDetection", engine),
+                non_detections,
+                non_detections[key].unique(),
+            )
         self.logger.info(
             f"Inserting {len(non_detections)} new non_detections {engine}"
         )
+        if engine == "psql":
+            self.driver.query("NonDetection", engine=engine).bulk_copy(
+                non_detections, staging=True
+            )
+            return
         non_detections.replace({np.nan: None}, inplace=True)
         dict_non_detections = non_detections.to_dict("records")
-        self.driver.query("NonDetection", engine=engine).bulk_insert(
+        driver = driver or self.driver
+        return driver.query("NonDetection", engine=engine).bulk_insert(
             dict_non_detections
         )
 
+    def write_buffered(self, name: Tuple[str, str], data: pd.DataFrame):
+        """Write the rows flushed by the write-behind buffer.
+
+        Parameters
+        ----------
+        name: Tuple with the model and engine of the rows
+        data: Rows of all the batches buffered since the last write
+        """
+        model, engine = name
+        if model == "Detection":
+            self.insert_detections(data, engine=engine, write_behind=False)
+        else:
+            self.insert_non_detections(data, engine=engine, write_behind=False)
+
+    def commit_buffered(self):
+        """Commit consumed offsets when buffered writes are done.
+
+        Every max_age seconds the buffer is flushed and then the offsets are
+        committed, so no batch is committed before its rows are written.
+        """
+        if time.monotonic() - self.last_commit < self.write_buffer.max_age:
+            return
+        self.write_buffer.flush()
+        self.consumer.commit()
+        self.last_commit = time.monotonic()
+
     @classmethod
     def calculate_stats_coordinates(cls, coordinates, e_coordinates):
         e_coordinates = e_coordinates / 3600
@@ -267,56 +555,200 @@ class IngestionStep(GenericStep):
                 f"Mean dec must be between -90 and 90 (given {mean_dec})"
             )
 
-    def apply_objs_stats_from_correction(self, df: pd.DataFrame) -> pd.Series:
-        response = {}
-        df_mjd = df.mjd
-        idx_min = df_mjd.values.argmin()
-        df_min = df.iloc[idx_min]
-        df_ra = df["ra"]
-        df_dec = df["dec"]
-        df_e_ra = df["e_ra"]
-        df_e_dec = df["e_dec"]
+    @staticmethod
+    def mean_coordinates(weight_sum, weighted_sum):
+        """Weighted mean coordinates and their errors, from their sums."""
+        mean_coordinate = weighted_sum / weight_sum
+        e_coord = np.sqrt(1 / weight_sum) * 3600
+        return mean_coordinate, e_coord
+
+    @staticmethod
+    def check_mean_coordinates(meanra, meandec):
+        wrong_ra = ~((meanra >= 0.0) & (meanra <= 360.0))
+        if wrong_ra.any():
+            raise ValueError(
+                "Mean ra must be between 0 and 360 "
+                f"(given {meanra[wrong_ra][0]})"
+            )
+        wrong_dec = ~((meandec >= -90.0) & (meandec <= 90.0))
+        if wrong_dec.any():
+            raise ValueError(
+                "Mean dec must be between -90 and 90 "
+                f"(given {meandec[wrong_dec][0]})"
+            )
+
+    def compute_objects_stats(self, detections: pd.DataFrame) -> pd.DataFrame:
+        """Compute statistics of all objects in a single grouped pass.
+
+        Detections are grouped by aid using factorized codes, so weighted
+        sums are computed with `np.bincount` instead of a Python function
+        for each object. The sums are returned too (see OBJ_SUM_KEYS).
+
+        Parameters
+        ----------
+        detections: Detections of all objects (without duplicates)
+
+        Returns A DataFrame with a row for each aid (sorted)
+        -------
+
+        """
+        codes, aids = pd.factorize(detections["aid"], sort=True)
+        n_objects = len(aids)
+
+        def weighted_sums(coordinates, e_coordinates):
+            # sums of calculate_stats_coordinates, but for every aid
+            weights = 1 / (e_coordinates / 3600) ** 2
+            weight_sum = np.bincount(
+                codes, weights=weights, minlength=n_objects
+            )
+            weighted_sum = np.bincount(
+                codes, weights=coordinates * weights, minlength=n_objects
+            )
+            return weight_sum, weighted_sum
 
-        response["meanra"], response["e_ra"] = self.compute_meanra(
-            df_ra, df_e_ra
+        ra_sums = weighted_sums(
+            detections["ra"].values.astype(float),
+            detections["e_ra"].values.astype(float),
         )
-        response["meandec"], response["e_dec"] = self.compute_meandec(
-            df_dec, df_e_dec
+        dec_sums = weighted_sums(
+            detections["dec"].values.astype(float),
+            detections["e_dec"].values.astype(float),
         )
-        response["firstmjd"] = df_mjd.min()
-        response["lastmjd"] = df_mjd.max()
-        response["tid"] = list(df["tid"].unique())
-        response["oid"] = list(df["oid"].unique())
-        response["ndet"] = len(df)
-        return pd.Series(response)
+        meanra, e_ra = self.mean_coordinates(*ra_sums)
+        meandec, e_dec = self.mean_coordinates(*dec_sums)
+        self.check_mean_coordinates(meanra, meandec)
+        mjd = pd.Series(detections["mjd"].values).groupby(codes)
+
+        def unique_values(column):
+            # unique values of each aid, in order of appearance
+            pairs = pd.DataFrame(
+                {"code": codes, column: detections[column].values}
+            ).drop_duplicates()
+            return pairs.groupby("code")[column].agg(list).values
+
+        return pd.DataFrame(
+            {
+                "aid": aids,
+                "meanra": meanra,
+                "e_ra": e_ra,
+                "meandec": meandec,
+                "e_dec": e_dec,
+                "firstmjd": mjd.min().values,
+                "lastmjd": mjd.max().values,
+                "tid": unique_values("tid"),
+                "oid": unique_values("oid"),
+                "ndet": np.bincount(codes, minlength=n_objects),
+                "ra_weight_sum": ra_sums[0],
+                "ra_weighted_sum": ra_sums[1],
+                "dec_weight_sum": dec_sums[0],
+                "dec_weighted_sum": dec_sums[1],
+            }
+        )
+
+    def update_objects_stats(
+        self, detections: pd.DataFrame, stored_objects: pd.DataFrame
+    ) -> pd.DataFrame:
+        """Update statistics of stored objects with their new detections.
+
+        An object is updated from its stored sums if it has them and its
+        stored ndet is the number of its detections already on database.
+        The rest are computed from all their detections.
+
+        Parameters
+        ----------
+        detections: Detections of all objects (without duplicates), with
+            the label `new`
+        stored_objects: Objects on database, with ndet and OBJ_SUM_KEYS
+
+        Returns A DataFrame like `compute_objects_stats`
+        -------
+
+        """
+        is_new = detections["new"].values.astype(bool)
+        stored = stored_objects.drop_duplicates("aid").set_index("aid")
+        old_ndet = detections["aid"][~is_new].value_counts()
+        old_ndet = old_ndet.reindex(stored.index, fill_value=0)
+        stored_ndet = pd.to_numeric(stored["ndet"], errors="coerce")
+        complete = (
+            stored[OBJ_SUM_KEYS + ["firstmjd", "lastmjd", "tid", "oid"]]
+            .notnull()
+            .all(axis=1)
+        )
+        stored = stored[complete & (stored_ndet == old_ndet)]
+        from_stored = detections["aid"].isin(stored.index).values
+        computed = self.compute_objects_stats(detections[~from_stored])
+        updates = self.compute_objects_stats(detections[from_stored & is_new])
+        updates = updates.set_index("aid").reindex(stored.index)
+        sums = {
+            key: stored[key].values.astype(float)
+            + updates[key].fillna(0).values
+            for key in OBJ_SUM_KEYS
+        }
+        meanra, e_ra = self.mean_coordinates(
+            sums["ra_weight_sum"], sums["ra_weighted_sum"]
+        )
+        meandec, e_dec = self.mean_coordinates(
+            sums["dec_weight_sum"], sums["dec_weighted_sum"]
+        )
+        self.check_mean_coordinates(meanra, meandec)
+
+        def add_values(column):
+            # stored values, then new ones in order of appearance
+            return [
+                (
+                    list(old) + [x for x in new if x not in old]
+                    if isinstance(new, list)
+                    else list(old)
+                )
+                for old, new in zip(stored[column], updates[column])
+            ]
+
+        updated = pd.DataFrame(
+            {
+                "aid": stored.index.values,
+                "meanra": meanra,
+                "e_ra": e_ra,
+                "meandec": meandec,
+                "e_dec": e_dec,
+                "firstmjd": np.fmin(
+                    stored["firstmjd"].values.astype(float),
+                    updates["firstmjd"].values,
+                ),
+                "lastmjd": np.fmax(
+                    stored["lastmjd"].values.astype(float),
+                    updates["lastmjd"].values,
+                ),
+                "tid": add_values("tid"),
+                "oid": add_values("oid"),
+                "ndet": stored_ndet[stored.index].values.astype(int)
+                + updates["ndet"].fillna(0).values.astype(int),
+                **sums,
+            }
+        )
+        objects = pd.concat([computed, updated], ignore_index=True)
+        return objects.sort_values("aid", ignore_index=True)
 
-    def preprocess_objects(self, objects: pd.DataFrame, light_curves: dict):
+    def preprocess_objects(self, light_curves: dict):
         """
 
         Parameters
         ----------
-        objects
         light_curves
 
         Returns
         -------
 
         """
-        # Keep existing objects
-        aids = objects["aid"].unique()
-        detections = light_curves["detections"].copy()
-        detections.drop_duplicates(
-            ["candid", "aid", "oid"], inplace=True, keep="first"
+        detections = light_curves["detections"].drop_duplicates(
+            ["candid", "aid", "oid"], keep="first", ignore_index=True
         )
-        detections.reset_index(inplace=True, drop=True)
         # New objects referer to: empirical new objects
         # (without detections in the past) and modified objects
         # (I mean existing objects in database)
-        new_objects = detections.groupby("aid").apply(
-            self.apply_objs_stats_from_correction
-        )
-        new_objects.reset_index(inplace=True)
-        new_objects["new"] = ~new_objects["aid"].isin(aids)
+        stored_objects = light_curves.get("objects")
+        if stored_objects is not None:
+            return self.update_objects_stats(detections, stored_objects)
+        new_objects = self.compute_objects_stats(detections)
         return new_objects
 
     def obj_stats(self, df: pd.DataFrame):
@@ -359,11 +791,9 @@ class IngestionStep(GenericStep):
         """
         # Keep existing objects
         oids = objects["oid"].unique()
-        detections = light_curves["detections"]
-        detections.drop_duplicates(
-            ["candid", "oid"], inplace=True, keep="first"
+        detections = light_curves["detections"].drop_duplicates(
+            ["candid", "oid"], keep="first", ignore_index=True
         )
-        detections.reset_index(inplace=True, drop=True)
         # New objects referer to: empirical new objects
         # (without detections in the past) and modified objects
         # (I mean existing objects in database)
@@ -387,6 +817,9 @@ class IngestionStep(GenericStep):
             "detections": self.get_detections(oids, engine=engine),
             "non_detections": self.get_non_detections(oids, engine=engine),
         }
+        if engine == "mongo" and self.incremental_object_stats:
+            # Stored stats of the objects, to update them
+            light_curves["objects"] = self.get_stored_objects(oids)
         self.logger.info(
             f"Light Curves ({len(oids)} objects) of this batch: "
             + f"{len(light_curves['detections'])} detections,"
@@ -395,11 +828,69 @@ class IngestionStep(GenericStep):
         )
         return light_curves
 
+    def _run_in_thread_session(self, function, *args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.driver.remove_session()
+
+    def prefetch_psql(self, oids: List[str]) -> dict:
+        """Retrieve all PSQL data of a batch at once.
+
+        None of these reads depend on each other, so they are issued
+        concurrently, each one with its own session from the pool.
+
+        Parameters
+        ----------
+        oids: List of ZTF object ids of the batch
+
+        Returns A dict with a DataFrame for each catalog ("Ss_ztf",
+        "Reference", "Ps1_ztf", "Gaia_ztf", "MagStats"), "objects",
+        "detections" and "non_detections"
+        -------
+
+        """
+        reads = {
+            table: (get_catalog, (oids, table, self.driver), {})
+            for table in PSQL_CATALOGS
+        }
+        reads["objects"] = (self.get_objects, (oids,), {"engine": "psql"})
+        reads["detections"] = (
+            self.get_detections,
+            (oids,),
+            {"engine": "psql"},
+        )
+        reads["non_detections"] = (
+            self.get_non_detections,
+            (oids,),
+            {"engine": "psql"},
+        )
+        max_workers = min(
+            self.prefetch_workers or len(reads), self.max_prefetch_workers
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                name: executor.submit(
+                    self._run_in_thread_session, function, *args, **kwargs
+                )
+                for name, (function, args, kwargs) in reads.items()
+            }
+            prefetched = {
+                name: future.result() for name, future in futures.items()
+            }
+        self.logger.info(
+            f"Prefetched PSQL data of {len(oids)} objects: "
+            + f"{len(prefetched['detections'])} detections,"
+            + f" {len(prefetched['non_detections'])} non_detections"
+        )
+        return prefetched
+
     def preprocess_lightcurves(
         self,
         detections: pd.DataFrame,
         non_detections: pd.DataFrame,
         engine="mongo",
+        light_curves: dict = None,
     ) -> dict:
         """
 
@@ -408,13 +899,15 @@ class IngestionStep(GenericStep):
         detections
         non_detections
         engine
+        light_curves: Light curves already retrieved from database. If None
+            they are retrieved here.
         Returns
         -------
 
         """
         # TODO: remove index in psql iteration
-        # Assign a label to difference new detections
-        detections["new"] = True
+        # Input frames are not modified (they may be shared with the other
+        # engine), new rows are labeled on the copies added to light curves
         # Get unique oids from new alerts
         if engine == "psql":
             aids = detections["oid"].unique().tolist()
@@ -422,7 +915,8 @@ class IngestionStep(GenericStep):
             aids = detections["aid"].unique().tolist()
         # Retrieve old detections and non_detections from database
         # and put new label to false
-        light_curves = self.get_lightcurves(aids, engine=engine)
+        if light_curves is None:
+            light_curves = self.get_lightcurves(aids, engine=engine)
         light_curves["detections"]["new"] = False
         light_curves["non_detections"]["new"] = False
         old_detections = light_curves["detections"]
@@ -435,54 +929,48 @@ class IngestionStep(GenericStep):
         else:
             unique_keys_detections = ["oid", "candid"]
         # Checking if already on the database
-        index_detections = pd.MultiIndex.from_frame(
-            detections[unique_keys_detections]
+        detections_already_on_db = isin_rows(
+            detections, old_detections, unique_keys_detections
         )
-        old_index_detections = pd.MultiIndex.from_frame(
-            old_detections[unique_keys_detections]
-        )
-        detections_already_on_db = index_detections.isin(old_index_detections)
         # Apply mask and get only new detections on detections from stream.
         new_detections = detections[~detections_already_on_db]
+        # Assign a label to difference new detections
+        new_detections["new"] = True
         # Get all light curve: only detections since beginning of time
         light_curves["detections"] = pd.concat(
             [old_detections, new_detections], ignore_index=True
         )
 
-        non_detections["new"] = True
         old_non_detections = light_curves["non_detections"]
         if len(non_detections):
-            # Using round 5 to have 5 decimals of precision to
-            # delete duplicates non_detections
-            non_detections["round_mjd"] = non_detections["mjd"].round(5)
-            old_non_detections["round_mjd"] = old_non_detections["mjd"].round(
-                5
-            )
-            # Remove [aid, fid, round_mjd] that are new non_dets
+            # Remove [aid, fid, mjd_key] that are new non_dets
             # and old non_dets.
             if engine == "mongo":
-                unique_keys_non_detections = ["aid", "fid", "round_mjd"]
+                unique_keys_non_detections = ["aid", "fid"]
             else:
-                unique_keys_non_detections = ["oid", "fid", "round_mjd"]
+                unique_keys_non_detections = ["oid", "fid"]
+            # Non detections are the same if their mjd match up to
+            # 5 decimals. Keys are compared on frames of their own.
+            non_detections_keys = non_detections[
+                unique_keys_non_detections
+            ].assign(mjd_key=mjd_key(non_detections["mjd"]))
+            old_non_detections_keys = old_non_detections[
+                unique_keys_non_detections
+            ].assign(mjd_key=mjd_key(old_non_detections["mjd"]))
             # Checking if already on the database
-            index_non_detections = pd.MultiIndex.from_frame(
-                non_detections[unique_keys_non_detections]
-            )
-            old_index_non_detections = pd.MultiIndex.from_frame(
-                old_non_detections[unique_keys_non_detections]
-            )
-            non_dets_already_on_db = index_non_detections.isin(
-                old_index_non_detections
+            non_dets_already_on_db = isin_rows(
+                non_detections_keys,
+                old_non_detections_keys,
+                unique_keys_non_detections + ["mjd_key"],
             )
             # Apply mask and get only new non detections on
             # non detections from stream.
             new_non_detections = non_detections[~non_dets_already_on_db]
+            new_non_detections["new"] = True
             # Get all light curve: only detections since beginning of time
-            non_detections = pd.concat(
+            light_curves["non_detections"] = pd.concat(
                 [old_non_detections, new_non_detections], ignore_index=True
             )
-            non_detections.drop(columns=["round_mjd"], inplace=True)
-            light_curves["non_detections"] = non_detections
         return light_curves
 
     def process_prv_candidates(
@@ -508,10 +996,10 @@ class IngestionStep(GenericStep):
         ]
         detections = []
         non_detections = []
-        for tid, subset_data in data.groupby("tid"):
+        for tid, subset_data in data.groupby("tid", observed=True):
             if tid == "ZTF":
                 self.prv_candidates_processor.strategy = (
-                    ZTFPrvCandidatesStrategy()
+                    ZTFPrvCandidatesStrategy(cache=self.prv_candidates_cache)
                 )
             elif "ATLAS" in tid:
                 self.prv_candidates_processor.strategy = (
@@ -538,7 +1026,7 @@ class IngestionStep(GenericStep):
 
         """
         response = []
-        for idx, gdf in detections.groupby("tid"):
+        for idx, gdf in detections.groupby("tid", observed=True):
             if "ZTF" == idx:
                 self.detections_corrector.strategy = ZTFCorrectionStrategy()
             elif "ATLAS" in idx:
@@ -581,26 +1069,41 @@ class IngestionStep(GenericStep):
         self.logger.info(f"Checking {len(objects)} messages (key={key})")
         n_messages = 0
         objects.set_index(key, inplace=True)
-        for index, row in alerts.iterrows():
-            _key = row[key]
-            aid = row["aid"]
-            oid = row["oid"]
-            candid = row["candid"]
-            tid = row["tid"]
-            metadata_ = None
-            if metadata is not None:
-                if oid in metadata.index:
-                    metadata_ = metadata.loc[oid].to_dict()
-            mask_detections = light_curves["detections"][key] == _key
-            detections = light_curves["detections"].loc[mask_detections]
-            detections.replace({np.nan: None}, inplace=True)
-            detections = detections.to_dict("records")
-            mask_non_detections = light_curves["non_detections"][key] == _key
-            non_detections = light_curves["non_detections"].loc[
-                mask_non_detections
-            ]
-            non_detections = non_detections.to_dict("records")
-            the_object = objects.loc[_key]
+        objects_stats = objects[["meanra", "meandec", "ndet"]].to_dict("index")
+        metadata = metadata.to_dict("index") if metadata is not None else {}
+        # Convert each light curve to records once, and index its rows by key
+        detections = light_curves["detections"].replace({np.nan: None})
+        detections_records = detections.to_dict("records")
+        detections_index = detections.groupby(key).indices
+        non_detections = light_curves["non_detections"]
+        non_detections_records = non_detections.to_dict("records")
+        non_detections_index = non_detections.groupby(key).indices
+        if self.unique_aid_messages:
+            alerts = alerts.sort_values("mjd").drop_duplicates(
+                "aid", keep="last"
+            )
+        # Alerts with the same key share the same light curve lists
+        payloads = {}
+        for _key, aid, oid, candid, tid in zip(
+            alerts[key].values,
+            alerts["aid"].values,
+            alerts["oid"].values,
+            alerts["candid"].values,
+            alerts["tid"].values,
+        ):
+            the_object = objects_stats[_key]
+            if _key not in payloads:
+                payloads[_key] = (
+                    [
+                        detections_records[i]
+                        for i in detections_index.get(_key, [])
+                    ],
+                    [
+                        non_detections_records[i]
+                        for i in non_detections_index.get(_key, [])
+                    ],
+                )
+            light_curve_detections, light_curve_non_detections = payloads[_key]
             output_message = {
                 "aid": str(aid),
                 "meanra": the_object["meanra"],
@@ -609,9 +1112,9 @@ class IngestionStep(GenericStep):
                 "candid": str(candid),
                 "tid": str(tid),
                 "oid": str(oid),
-                "detections": detections,
-                "non_detections": non_detections,
-                "metadata": metadata_,
+                "detections": light_curve_detections,
+                "non_detections": light_curve_non_detections,
+                "metadata": metadata.get(oid),
             }
             self.producer.produce(output_message, key=aid)
             n_messages += 1
@@ -623,22 +1126,20 @@ class IngestionStep(GenericStep):
         alerts: pd.DataFrame,
         detections: pd.DataFrame,
         non_detections_prv_candidates: pd.DataFrame,
+        prefetched: dict = None,
     ):
-        # Get just ZTF objects
-        alerts = alerts[alerts["tid"] == "ZTF"]
+        # Inputs are shared with the Mongo branch, so they are never
+        # modified here. Get just ZTF objects (indexed from 0)
+        alerts = select_rows(alerts, alerts["tid"] == "ZTF")
         # No alerts of ZTF on the batch, continue
         if len(alerts) == 0:
             return
         self.logger.info("Working on PSQL")
-        detections = detections[detections["tid"] == "ZTF"]
-        non_detections_prv_candidates = non_detections_prv_candidates[
-            non_detections_prv_candidates["tid"] == "ZTF"
-        ]
-
-        # Reset all indexes
-        alerts.reset_index(inplace=True)
-        detections.reset_index(inplace=True)
-        non_detections_prv_candidates.reset_index(inplace=True)
+        detections = select_rows(detections, detections["tid"] == "ZTF")
+        non_detections_prv_candidates = select_rows(
+            non_detections_prv_candidates,
+            non_detections_prv_candidates["tid"] == "ZTF",
+        )
         # Get unique oids for ZTF
         unique_oids = alerts["oid"].unique().tolist()
         # Create a new dataframe with extra fields and remove it from detections
@@ -647,34 +1148,44 @@ class IngestionStep(GenericStep):
         for c in ["prv_candidates", "pid"]:
             if c in extra_fields.columns:
                 extra_fields.drop(columns=[c], inplace=True)
-        del detections["extra_fields"]
         # Join detections with extra fields (old format of detections)
         detections = detections.join(extra_fields)
+        del detections["extra_fields"]
         detections["magpsf"] = detections["mag"]
         detections["sigmapsf"] = detections["e_mag"]
+        # Get all data of this batch from database
+        if prefetched is None:
+            prefetched = self.prefetch_psql(unique_oids)
         # Get catalogs data and combined it with historic data
         # Dataquality
         dataquality = preprocess_dataquality(detections)
         # SS
-        ss = get_catalog(unique_oids, "Ss_ztf", self.driver)
-        ss = preprocess_ss(ss, detections)
+        ss = preprocess_ss(prefetched["Ss_ztf"], detections)
         # Reference
-        reference = get_catalog(unique_oids, "Reference", self.driver)
-        reference = preprocess_reference(reference, detections)
+        reference = preprocess_reference(prefetched["Reference"], detections)
         # PS1
-        ps1 = get_catalog(unique_oids, "Ps1_ztf", self.driver)
-        ps1 = preprocess_ps1(ps1, detections)
+        ps1 = preprocess_ps1(prefetched["Ps1_ztf"], detections)
         # GAIA
-        gaia = get_catalog(unique_oids, "Gaia_ztf", self.driver)
-        gaia = preprocess_gaia(gaia, detections)
+        gaia = preprocess_gaia(prefetched["Gaia_ztf"], detections)
         # Get historic
         light_curves = self.preprocess_lightcurves(
-            detections, non_detections_prv_candidates, engine="psql"
+            detections,
+            non_detections_prv_candidates,
+            engine="psql",
+            light_curves={
+                "detections": prefetched["detections"],
+                "non_detections": prefetched["non_detections"],
+            },
         )
         # compute magstats with historic catalogs
-        old_magstats = get_catalog(unique_oids, "MagStats", self.driver)
+        old_magstats = prefetched["MagStats"]
         new_magstats = do_magstats(
-            light_curves, old_magstats, ps1, reference, self.version
+            light_curves,
+            old_magstats,
+            ps1,
+            reference,
+            self.version,
+            incremental=self.incremental_magstats,
         )
         # Compute flags
         obj_flags, magstat_flags = do_flags(
@@ -701,9 +1212,12 @@ class IngestionStep(GenericStep):
         new_stats.loc[magstat_flags.index, "saturation_rate"] = magstat_flags
         new_stats.reset_index(inplace=True)
         # Get objects and store it
-        objects = self.get_objects(unique_oids, engine="psql")
         objects = preprocess_objects_(
-            objects, light_curves, alerts, new_stats, self.version
+            prefetched["objects"],
+            light_curves,
+            alerts,
+            new_stats,
+            self.version,
         )
         #         objects = self.preprocess_objects_psql(objects, light_curves)
         objects.set_index("oid", inplace=True)
@@ -724,7 +1238,6 @@ class IngestionStep(GenericStep):
         new_detections["step_id_corr"] = self.version
         new_detections.drop(columns=["new"], inplace=True)
         new_detections = new_detections[OLD_DET_KEYS]
-        new_detections = new_detections.replace({np.nan: None})
         self.insert_detections(new_detections, engine="psql")
         # Store new non detections
         new_non_detections = light_curves["non_detections"]["new"]
@@ -755,47 +1268,242 @@ class IngestionStep(GenericStep):
         alerts: pd.DataFrame,
         detections: pd.DataFrame,
         non_detections_prv_candidates: pd.DataFrame,
-        metadata: pd.DataFrame,
-    ):
-        # Get unique alerce ids for get objects from database
-        unique_aids = alerts["aid"].unique().tolist()
-        # Concat new and old detections and non detections.
-        light_curves = self.preprocess_lightcurves(
+    ) -> Tuple[pd.DataFrame, dict]:
+        objects, light_curves = self.process_mongo(
             detections, non_detections_prv_candidates
         )
+        self.write_mongo(objects, light_curves)
+        return objects, light_curves
 
-        # Getting other tables: retrieve existing objects
-        # and create new objects
-        objects = self.get_objects(unique_aids)
-        objects = self.preprocess_objects(objects, light_curves)
-        # Insert new objects and update old objects on database
-        self.insert_objects(objects)
+    def process_mongo(
+        self,
+        detections: pd.DataFrame,
+        non_detections_prv_candidates: pd.DataFrame,
+        light_curves: dict = None,
+    ) -> Tuple[pd.DataFrame, dict]:
+        # Concat new and old detections and non detections.
+        light_curves = self.preprocess_lightcurves(
+            detections,
+            non_detections_prv_candidates,
+            light_curves=light_curves,
+        )
+        # Compute objects from their light curves
+        objects = self.preprocess_objects(light_curves)
+        return objects, light_curves
+
+    def write_mongo(
+        self, objects: pd.DataFrame, light_curves: dict, driver=None
+    ) -> list:
+        # Upsert objects on database
+        objects_write = self.insert_objects(objects, driver=driver)
         # Insert new detections and put step_version
         new_detections = light_curves["detections"]["new"]
         new_detections = light_curves["detections"][new_detections]
         new_detections["step_id_corr"] = self.version
         new_detections.drop(columns=["new"], inplace=True)
-        self.insert_detections(new_detections)
+        detections_write = self.insert_detections(
+            new_detections, driver=driver
+        )
         # Insert new now detections
         new_non_detections = light_curves["non_detections"]["new"]
         new_non_detections = light_curves["non_detections"][new_non_detections]
         new_non_detections.drop(columns=["new"], inplace=True)
-        self.insert_non_detections(new_non_detections)
-        # produce to some topic
-        if self.producer:
-            self.produce(alerts, objects, light_curves, metadata)
-        del light_curves["detections"]
-        del light_curves["non_detections"]
-        del light_curves
-        del objects
+        non_detections_write = self.insert_non_detections(
+            new_non_detections, driver=driver
+        )
         del new_detections
         del new_non_detections
+        return [objects_write, detections_write, non_detections_write]
+
+    def execute_concurrently(
+        self,
+        alerts: pd.DataFrame,
+        detections: pd.DataFrame,
+        non_detections_prv_candidates: pd.DataFrame,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, dict]:
+        """Run PSQL and Mongo branches at the same time.
+
+        Both branches share ``self.driver``: the PSQL branch runs in its
+        own thread-scoped session (removed when it ends) taken from the
+        shared engine pool, and the Mongo branch uses the shared client,
+        which is thread safe. Neither branch modifies the input data.
+
+        Parameters
+        ----------
+        alerts
+        detections
+        non_detections_prv_candidates
+
+        Returns A tuple with metadata (from PSQL), objects and light curves
+        (both from Mongo)
+        -------
+
+        """
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            psql_future = executor.submit(
+                self._run_in_thread_session,
+                self.execute_psql,
+                alerts,
+                detections,
+                non_detections_prv_candidates,
+            )
+            mongo_future = executor.submit(
+                self.execute_mongo,
+                alerts,
+                detections,
+                non_detections_prv_candidates,
+            )
+            metadata = psql_future.result()
+            objects, light_curves = mongo_future.result()
+        return metadata, objects, light_curves
+
+    async def read_batch_async(
+        self, aids: List[str], oids: List[str]
+    ) -> Tuple[dict, dict]:
+        """Retrieve Mongo light curves and PSQL data of a batch at once.
+
+        Parameters
+        ----------
+        aids: List of aids of the batch
+        oids: List of ZTF object ids of the batch
+
+        Returns A tuple with the Mongo light curves and a dict like the one
+        of `prefetch_psql` (None if there are no ZTF objects)
+        -------
+
+        """
+        reads = {
+            "detections": self._find_by_aids_async(
+                "Detection", aids, DET_KEYS, "mongo"
+            ),
+            "non_detections": self._find_by_aids_async(
+                "NonDetection", aids, NON_DET_KEYS, "mongo"
+            ),
+        }
+        if self.incremental_object_stats:
+            reads["mongo_objects"] = self._find_by_aids_async(
+                "Object", aids, STORED_OBJ_KEYS, "mongo", key="_id"
+            )
+        if len(oids):
+            psql_reads = {table: table for table in PSQL_CATALOGS}
+            psql_reads.update(
+                {
+                    "objects": "Object",
+                    "psql_detections": "Detection",
+                    "psql_non_detections": "NonDetection",
+                }
+            )
+            for name, model in psql_reads.items():
+                reads[name] = self._find_by_aids_async(
+                    model, oids, None, "psql"
+                )
+        results = dict(
+            zip(reads.keys(), await asyncio.gather(*reads.values()))
+        )
+        light_curves = {
+            "detections": self._to_frame(
+                results.pop("detections"), DET_KEYS, "mongo"
+            ),
+            "non_detections": self._to_frame(
+                results.pop("non_detections"), NON_DET_KEYS, "mongo"
+            ),
+        }
+        if self.incremental_object_stats:
+            light_curves["objects"] = self._stored_objects_frame(
+                results.pop("mongo_objects")
+            )
+        if not len(oids):
+            return light_curves, None
+        # Same shape of the data given by prefetch_psql
+        prefetched = {
+            table: results[table].replace({np.nan: None})
+            for table in PSQL_CATALOGS
+        }
+        prefetched["objects"] = self._to_frame(
+            results["objects"], OBJ_KEYS, "psql"
+        )
+        prefetched["detections"] = self._to_frame(
+            results["psql_detections"], DET_KEYS, "psql"
+        )
+        prefetched["non_detections"] = self._to_frame(
+            results["psql_non_detections"], NON_DET_KEYS, "psql"
+        )
+        return light_curves, prefetched
+
+    def _find_by_aids_async(
+        self,
+        model: str,
+        aids: List[str or int],
+        columns: List[str],
+        engine,
+        key: str = "aid",
+    ):
+        query = self.async_driver.query(model, engine=engine)
+        filter_by = {key: {"$in": aids}}
+        if engine == "mongo":
+            return query.find_dataframe(
+                filter_by=filter_by,
+                columns=columns,
+                batch_size=self.mongo_batch_size,
+            )
+        return query.find_dataframe(filter_by=filter_by)
+
+    async def execute_async(
+        self,
+        alerts: pd.DataFrame,
+        detections: pd.DataFrame,
+        non_detections_prv_candidates: pd.DataFrame,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame, dict]:
+        """Run the batch overlapping its database reads and writes.
+
+        All reads (Mongo and PSQL) are awaited together. Then the PSQL
+        branch runs in the loop executor (its writes use psycopg2) while
+        Mongo writes are awaited on the async driver.
+
+        Parameters
+        ----------
+        alerts
+        detections
+        non_detections_prv_candidates
+
+        Returns A tuple with metadata (from PSQL), objects and light curves
+        (both from Mongo)
+        -------
+
+        """
+        aids = detections["aid"].unique().tolist()
+        oids = alerts.loc[alerts["tid"] == "ZTF", "oid"].unique().tolist()
+        light_curves, prefetched = await self.read_batch_async(aids, oids)
+        psql_future = asyncio.get_running_loop().run_in_executor(
+            None,
+            self._run_in_thread_session,
+            self.execute_psql,
+            alerts,
+            detections,
+            non_detections_prv_candidates,
+            prefetched,
+        )
+        objects, light_curves = self.process_mongo(
+            detections, non_detections_prv_candidates, light_curves
+        )
+        # Writes sent to the write-behind buffer have nothing to await
+        mongo_writes = [
+            write
+            for write in self.write_mongo(
+                objects, light_curves, driver=self.async_driver
+            )
+            if write is not None
+        ]
+        results = await asyncio.gather(psql_future, *mongo_writes)
+        return results[0], objects, light_curves
 
     def execute(self, messages):
         self.logger.info(f"Processing {len(messages)} alerts")
         alerts = pd.DataFrame(messages)
         # If is an empiric alert must has stamp
         alerts["has_stamp"] = True
+        if self.categorical_ids:
+            categorize_ids([alerts])
         # Process previous candidates of each alert
         (
             dets_from_prv_candidates,
@@ -818,17 +1526,54 @@ class IngestionStep(GenericStep):
         detections.drop_duplicates(
             "candid", inplace=True, keep="first", ignore_index=True
         )
+        if self.categorical_ids:
+            # Detections from prv candidates may add new ids
+            categorize_ids([alerts, detections])
         # Do correction to detections from stream
         detections = self.correct(detections)
-        # Insert/update data on mongo and get metadata
-        metadata = self.execute_psql(
-            alerts.copy(),
-            detections.copy(),
-            non_dets_from_prv_candidates.copy(),
-        )
-        self.execute_mongo(
-            alerts, detections, non_dets_from_prv_candidates, metadata
-        )
+        if self.categorical_ids:
+            # Light curves read from the databases have object ids
+            restore_ids([alerts, detections])
+        # Light curves read on this batch must include buffered rows
+        if self.write_buffer is not None and self.write_buffer.is_pending(
+            np.concatenate([alerts["aid"].unique(), alerts["oid"].unique()])
+        ):
+            self.write_buffer.flush()
+        # Insert/update data on psql and mongo and get metadata
+        if self.async_execution:
+            metadata, objects, light_curves = self.loop.run_until_complete(
+                self.execute_async(
+                    alerts, detections, non_dets_from_prv_candidates
+                )
+            )
+        elif self.concurrent_execution:
+            metadata, objects, light_curves = self.execute_concurrently(
+                alerts, detections, non_dets_from_prv_candidates
+            )
+        else:
+            metadata = self.execute_psql(
+                alerts, detections, non_dets_from_prv_candidates
+            )
+            objects, light_curves = self.execute_mongo(
+                alerts, detections, non_dets_from_prv_candidates
+            )
+        # produce to some topic
+        if self.producer:
+            self.produce(alerts, objects, light_curves, metadata)
+        # Previous candidates of this batch are stored, don't process them
+        # again on next alerts of the same objects
+        if self.prv_candidates_cache is not None:
+            ztf_alerts = alerts[alerts["tid"] == "ZTF"]
+            self.prv_candidates_cache.update(
+                ztf_alerts["oid"].values, ztf_alerts["mjd"].values + 2400000.5
+            )
+        if self.write_buffer is not None:
+            self.commit_buffered()
+        self.logger.debug(f"Connection pools: {self.driver.pool_status()}")
+        del light_curves["detections"]
+        del light_curves["non_detections"]
+        del light_curves
+        del objects
 
         self.logger.info(f"Clean batch of data\n")
         del alerts
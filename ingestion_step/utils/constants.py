@@ -33,6 +33,14 @@ OBJ_KEYS = [
     "e_ra",
     "e_dec",
 ]
+# Sums of weights and weighted coordinates of the detections of an object,
+# stored to update its mean coordinates with new detections only
+OBJ_SUM_KEYS = [
+    "ra_weight_sum",
+    "ra_weighted_sum",
+    "dec_weight_sum",
+    "dec_weighted_sum",
+]
 DATAQUALITY_KEYS = [
     "oid",
     "candid",
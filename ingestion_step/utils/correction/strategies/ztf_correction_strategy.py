@@ -5,18 +5,50 @@ from .base_correction_strategy import BaseCorrectionStrategy
 from lc_correction.compute import correction, is_dubious, DISTANCE_THRESHOLD
 
 
-class ZTFCorrectionStrategy(BaseCorrectionStrategy):
-    @classmethod
-    def get_first_corrected(cls, df):
-        min_candid = df["candid"].values.argmin()
-        first_corr = df["corrected"].iloc[min_candid]
-        return first_corr
+def correction_array(
+    magnr: np.ndarray,
+    magpsf: np.ndarray,
+    sigmagnr: np.ndarray,
+    sigmapsf: np.ndarray,
+    isdiffpos: np.ndarray,
+):
+    """Array version of `lc_correction.compute.correction`.
+
+    The formula is evaluated over whole columns. Rows that fall on a special
+    case of the formula (negative magnitudes, non positive corrected flux or
+    negative variance) are delegated to `correction`, so the output is the
+    same as calling it row by row.
+
+    Returns a tuple of arrays: magpsf_corr, sigmapsf_corr, sigmapsf_corr_ext
+    """
+    with np.errstate(all="ignore"):
+        aux1 = 10 ** (-0.4 * magnr)
+        aux2 = 10 ** (-0.4 * magpsf)
+        aux3 = aux1 + isdiffpos * aux2
+        aux4 = aux2**2 * sigmapsf**2 - aux1**2 * sigmagnr**2
+        regular = (magnr >= 0) & (magpsf >= 0) & (aux3 > 0) & (aux4 >= 0)
+        magpsf_corr = np.where(regular, -2.5 * np.log10(aux3), np.nan)
+        sigmapsf_corr = np.where(regular, np.sqrt(aux4) / aux3, np.nan)
+        sigmapsf_corr_ext = np.where(regular, aux2 * sigmapsf / aux3, np.nan)
+    for i in np.flatnonzero(~regular):
+        (
+            magpsf_corr[i],
+            sigmapsf_corr[i],
+            sigmapsf_corr_ext[i],
+        ) = correction(
+            magnr[i], magpsf[i], sigmagnr[i], sigmapsf[i], isdiffpos[i]
+        )
+    return magpsf_corr, sigmapsf_corr, sigmapsf_corr_ext
 
+
+class ZTFCorrectionStrategy(BaseCorrectionStrategy):
     def do_dubious(self, df: pd.DataFrame):
         # was the first detection corrected?
-        min_corr = df.groupby(["oid", "fid"], sort=False).apply(
-            self.get_first_corrected
-        )
+        first = df.groupby(["oid", "fid"], sort=False, observed=True)[
+            "candid"
+        ].idxmin()
+        min_corr = df.loc[first.values, "corrected"]
+        min_corr.index = first.index
         min_corr.name = "first_corrected"
         # join with detections dataframe
         df = df.join(min_corr, on=["oid", "fid"], how="left")
@@ -26,65 +58,47 @@ class ZTFCorrectionStrategy(BaseCorrectionStrategy):
 
     def do_correction(self, detections: pd.DataFrame) -> pd.DataFrame:
         # Retrieve some metadata for do correction
-        fields = detections["extra_fields"].apply(
-            lambda x: [x["distnr"], x["magnr"], x["sigmagnr"]]
-        )
-        # Create an auxiliary dataframe for correction
-        df = pd.DataFrame(
-            list(fields), columns=["distnr", "magnr", "sigmagnr"]
-        )
-        # Uses candid like index
-        df.index = detections["candid"]
-        # Additional columns for correction
-        df.loc[:, ["magpsf", "sigmapsf"]] = detections[["mag", "e_mag"]].values
-        df.loc[:, "isdiffpos"] = detections["isdiffpos"].values
+        extra_fields = detections["extra_fields"].values
+        magnr = np.array([x["magnr"] for x in extra_fields], dtype=float)
+        sigmagnr = np.array([x["sigmagnr"] for x in extra_fields], dtype=float)
+        distnr = np.array([x["distnr"] for x in extra_fields], dtype=float)
         # Is possible correct that detection?
-        df["corrected"] = df["distnr"] < DISTANCE_THRESHOLD
-        # Apply formula of correction: corrected is the dataframe with response
-        corrected = df.apply(
-            lambda x: correction(
-                x.magnr, x.magpsf, x.sigmagnr, x.sigmapsf, x.isdiffpos
-            )
-            if x["corrected"]
-            else (np.nan, np.nan, np.nan),
-            axis=1,
-            result_type="expand",
+        corrected = distnr < DISTANCE_THRESHOLD
+        # Apply formula of correction only over detections that can be
+        # corrected, the rest keep NaN values
+        magpsf_corr = np.full(len(detections), np.nan)
+        sigmapsf_corr = np.full(len(detections), np.nan)
+        sigmapsf_corr_ext = np.full(len(detections), np.nan)
+        (
+            magpsf_corr[corrected],
+            sigmapsf_corr[corrected],
+            sigmapsf_corr_ext[corrected],
+        ) = correction_array(
+            magnr[corrected],
+            detections["mag"].values.astype(float)[corrected],
+            sigmagnr[corrected],
+            detections["e_mag"].values.astype(float)[corrected],
+            detections["isdiffpos"].values.astype(float)[corrected],
         )
-        corrected.columns = [
-            "magpsf_corr",
-            "sigmapsf_corr",
-            "sigmapsf_corr_ext",
-        ]
-        corrected["corrected"] = df["corrected"]
-        # Create new columns for correction fields: use candid index to join.
-        detections = detections.set_index("candid")
-        detections = detections.join(corrected)
-        # Reset index and get candid column again
-        detections.reset_index(inplace=True)
+        detections = detections.reset_index(drop=True)
+        detections["corrected"] = corrected
         # Apply dubious logic
-        detections["dubious"] = self.do_dubious(detections)
+        dubious = self.do_dubious(detections)
         # Move correction field to extra_fields
-        detections["extra_fields"] = detections.apply(
-            lambda x: {
-                **x["extra_fields"],
-                "magpsf_corr": x["magpsf_corr"],
-                "sigmapsf_corr": x["sigmapsf_corr"],
-                "sigmapsf_corr_ext": x["sigmapsf_corr_ext"],
-                "dubious": x["dubious"],
-            },
-            axis=1,
-        )
-        # Remove correction columns of dataframe
-        detections.drop(
-            columns=[
-                "magpsf_corr",
-                "sigmapsf_corr",
-                "sigmapsf_corr_ext",
-                "dubious",
-            ],
-            inplace=True,
-        )
-        del fields
-        del df
-        del corrected
+        detections["extra_fields"] = [
+            {
+                **extra,
+                "magpsf_corr": mag_corr,
+                "sigmapsf_corr": sigma_corr,
+                "sigmapsf_corr_ext": sigma_corr_ext,
+                "dubious": dub,
+            }
+            for extra, mag_corr, sigma_corr, sigma_corr_ext, dub in zip(
+                extra_fields,
+                magpsf_corr.tolist(),
+                sigmapsf_corr.tolist(),
+                sigmapsf_corr_ext.tolist(),
+                np.asarray(dubious).tolist(),
+            )
+        ]
         return detections
@@ -1 +1,2 @@
 from .connection import MultiDriverConnection
+from .async_connection import AsyncMultiDriverConnection
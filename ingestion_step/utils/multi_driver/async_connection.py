@@ -0,0 +1,219 @@
+from ingestion_step.utils.multi_driver.connection import (
+    mongo_client_options,
+    psql_pool_capacity,
+    psql_url,
+)
+from ingestion_step.utils.multi_driver.query import get_model, mongo_upsert
+from pymongo import UpdateOne
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+# Optional dependencies, only needed to run the step with ASYNC_EXECUTION
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient
+except ImportError:
+    AsyncIOMotorClient = None
+
+
+def filter_to_asyncpg(model: object, filter_by: dict):
+    """Translate a Mongo style filter to a PSQL WHERE clause.
+
+    Values are returned apart, to be sent as $n arguments. $in lists are
+    sent as a single array argument.
+
+    Returns a tuple with the clause and its arguments
+    """
+    clauses = []
+    arguments = []
+    for attribute, _filter in filter_by.items():
+        if not isinstance(_filter, dict):
+            arguments.append(_filter)
+            clauses.append(f'"{attribute}" = ${len(arguments)}')
+        elif "$in" in _filter:
+            attribute = "oid" if attribute == "aid" else attribute
+            arguments.append(list(_filter["$in"]))
+            clauses.append(f'"{attribute}" = ANY(${len(arguments)})')
+    return " AND ".join(clauses), arguments
+
+
+class AsyncMultiQuery:
+    """Asyncio version of MultiQuery, all its methods are coroutines."""
+
+    def __init__(self, psql_pool, mongo_database, model=None, **kwargs):
+        self.model = model
+        self.psql = psql_pool
+        self.mongo = mongo_database
+        self.engine = kwargs.get("engine", "mongo")
+
+    def _mongo_collection(self, model):
+        return self.mongo[model.__tablename__]
+
+    async def _psql_fetch(self, filter_by: dict, columns: List[str] = None):
+        model = get_model(self.engine, self.model)
+        table = model.__table__
+        columns = columns or [c.name for c in table.columns]
+        where_clause, arguments = filter_to_asyncpg(model, filter_by)
+        statement = 'SELECT {} FROM "{}"'.format(
+            ", ".join(f'"{c}"' for c in columns), table.name
+        )
+        if where_clause:
+            statement += f" WHERE {where_clause}"
+        records = await self.psql.fetch(statement, *arguments)
+        return records, columns
+
+    async def find_all(self, filter_by={}, paginate=False):
+        """Retrieve all items from the result of this query."""
+        model = get_model(self.engine, self.model)
+        if self.engine == "mongo":
+            cursor = self._mongo_collection(model).find(filter_by)
+            return [x async for x in cursor]
+        elif self.engine == "psql":
+            records, columns = await self._psql_fetch(filter_by)
+            return [dict(zip(columns, record)) for record in records]
+
+    async def find_dataframe(
+        self, filter_by={}, columns: List[str] = None, batch_size: int = None
+    ):
+        """Retrieve all items of this query as a DataFrame.
+
+        Same as `MultiQuery.find_dataframe`.
+        """
+        model = get_model(self.engine, self.model)
+        if self.engine == "mongo":
+            if columns is None:
+                return pd.DataFrame(await self.find_all(filter_by=filter_by))
+            projection = {column: 1 for column in columns}
+            if "_id" not in projection:
+                projection["_id"] = 0
+            cursor = self._mongo_collection(model).find(filter_by, projection)
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+            values = {column: [] for column in columns}
+            async for document in cursor:
+                for column in columns:
+                    values[column].append(document.get(column, np.nan))
+            return pd.DataFrame(values, columns=columns)
+        elif self.engine == "psql":
+            records, columns = await self._psql_fetch(filter_by, columns)
+            return pd.DataFrame.from_records(
+                [tuple(record) for record in records], columns=columns
+            )
+
+    async def bulk_insert(self, objects: List[dict]):
+        if len(objects) == 0:
+            return
+        model = get_model(self.engine, self.model)
+        if self.engine == "mongo":
+            documents = [model(**x) for x in objects]
+            return await self._mongo_collection(model).insert_many(documents)
+        elif self.engine == "psql":
+            table = model.__table__
+            columns = [k for k in objects[0].keys() if k in table.columns]
+            statement = 'INSERT INTO "{}" ({}) VALUES ({})'.format(
+                table.name,
+                ", ".join(f'"{c}"' for c in columns),
+                ", ".join(f"${i + 1}" for i in range(len(columns))),
+            )
+            rows = [tuple(x[c] for c in columns) for x in objects]
+            return await self.psql.executemany(statement, rows)
+
+    async def bulk_update(self, to_update: List[dict], filter_by: List[dict]):
+        if len(to_update) == 0:
+            return
+        model = get_model(self.engine, self.model)
+        if self.engine == "mongo":
+            operations = [
+                UpdateOne(_filter, {"$set": model(**document)})
+                for document, _filter in zip(to_update, filter_by)
+            ]
+            return await self._mongo_collection(model).bulk_write(operations)
+        elif self.engine == "psql":
+            # Same as update_to_psql, _id filters are oid
+            keys = [
+                "oid" if attribute == "_id" else attribute
+                for attribute in filter_by[0].keys()
+            ]
+            columns = list(to_update[0].keys())
+            statement = 'UPDATE "{}" SET {} WHERE {}'.format(
+                model.__table__.name,
+                ", ".join(f'"{c}" = ${i + 1}' for i, c in enumerate(columns)),
+                " AND ".join(f'"{k}" = ${columns.index(k) + 1}' for k in keys),
+            )
+            rows = [tuple(x[c] for c in columns) for x in to_update]
+            return await self.psql.executemany(statement, rows)
+
+    async def bulk_upsert(
+        self,
+        to_upsert: List[dict],
+        filter_by: List[dict],
+        raw_fields: List[str] = None,
+    ):
+        """Insert or update many documents in a single request (only Mongo).
+
+        Same as `MultiQuery.bulk_upsert`.
+        """
+        if self.engine != "mongo":
+            raise NotImplementedError()
+        model = get_model(self.engine, self.model)
+        operations = [
+            mongo_upsert(model, document, _filter, raw_fields)
+            for document, _filter in zip(to_upsert, filter_by)
+        ]
+        return await self._mongo_collection(model).bulk_write(
+            operations, ordered=False
+        )
+
+
+class AsyncMultiDriverConnection:
+    """Asyncio version of MultiDriverConnection.
+
+    It uses asyncpg for PSQL and motor for Mongo. Queries have the same
+    methods as MultiQuery, but they must be awaited.
+    """
+
+    def __init__(self, config: dict):
+        if asyncpg is None or AsyncIOMotorClient is None:
+            raise ImportError("Async driver requires asyncpg and motor")
+        self.config = config
+        self.psql_pool = None
+        self.mongo_client = None
+        self.mongo_database = None
+
+    async def connect(self):
+        pool_config = self.config.get("POOL") or {}
+        # asyncpg takes the same URL without the SQLAlchemy driver name
+        scheme, address = psql_url(self.config["PSQL"]).split("://", 1)
+        # The sync engine pool stays open next to this one, so connections
+        # are opened on demand up to the same capacity
+        self.psql_pool = await asyncpg.create_pool(
+            dsn=f"{scheme.split('+')[0]}://{address}",
+            min_size=1,
+            max_size=psql_pool_capacity(self.config),
+        )
+        options = {
+            **mongo_client_options(self.config["MONGO"]),
+            **(pool_config.get("MONGO") or {}),
+        }
+        self.mongo_client = AsyncIOMotorClient(**options)
+        self.mongo_database = self.mongo_client[
+            self.config["MONGO"]["DATABASE"]
+        ]
+
+    async def close(self):
+        if self.psql_pool is not None:
+            await self.psql_pool.close()
+            self.psql_pool = None
+        if self.mongo_client is not None:
+            self.mongo_client.close()
+            self.mongo_client = None
+
+    def query(self, query_class=None, *args, **kwargs):
+        return AsyncMultiQuery(
+            self.psql_pool, self.mongo_database, query_class, **kwargs
+        )
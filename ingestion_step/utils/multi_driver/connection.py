@@ -2,6 +2,113 @@ from db_plugins.db.generic import DatabaseConnection
 from db_plugins.db.mongo import MongoConnection
 from db_plugins.db.sql import SQLConnection
 from ingestion_step.utils.multi_driver.query import MultiQuery
+from pymongo import MongoClient
+from pymongo.monitoring import ConnectionPoolListener
+from sqlalchemy import create_engine
+
+import threading
+
+MONGO_CLIENT_KEYS = {
+    "HOST": "host",
+    "PORT": "port",
+    "USER": "username",
+    "PASSWORD": "password",
+    "AUTH_SOURCE": "authSource",
+}
+# Pool size and overflow of SQLAlchemy engines when none is configured
+PSQL_POOL_DEFAULTS = {"pool_size": 5, "max_overflow": 10}
+
+
+class MongoPoolCounter(ConnectionPoolListener):
+    """Keep count of open and checked out connections of a Mongo client."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.open = 0
+        self.checked_out = 0
+
+    def _add(self, attribute, value):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + value)
+
+    def connection_created(self, event):
+        self._add("open", 1)
+
+    def connection_closed(self, event):
+        self._add("open", -1)
+
+    def connection_checked_out(self, event):
+        self._add("checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+
+def psql_url(config: dict) -> str:
+    """Database URL of a PSQL config, as the SQL driver builds it."""
+    if config.get("SQLALCHEMY_DATABASE_URL"):
+        return config["SQLALCHEMY_DATABASE_URL"]
+    return (
+        f"{config['ENGINE']}://{config['USER']}:{config['PASSWORD']}"
+        f"@{config['HOST']}:{config['PORT']}/{config['DB_NAME']}"
+    )
+
+
+def mongo_client_options(config: dict) -> dict:
+    """MongoClient arguments of a Mongo config.
+
+    Known keys are renamed to the client argument names, the database name
+    is left out (it isn't a client option) and any other key is passed
+    as it is.
+    """
+    options = {}
+    for key, value in config.items():
+        if key == "DATABASE":
+            continue
+        options[MONGO_CLIENT_KEYS.get(key, key)] = value
+    return options
+
+
+def psql_pool_capacity(config: dict) -> int:
+    """Max number of connections the PSQL engine pool hands out."""
+    pool_config = (config.get("POOL") or {}).get("PSQL") or {}
+    pool_config = {**PSQL_POOL_DEFAULTS, **pool_config}
+    return pool_config["pool_size"] + max(pool_config["max_overflow"], 0)
+
+
+def psql_read_connections(config: dict) -> int:
+    """Max number of PSQL connections a single read holds at once.
+
+    Only reads split in chunks use more than one, a connection for each
+    chunk worker. Chunk workers are capped at the pool capacity, so they
+    never wait for each other's connections.
+    """
+    query_config = config.get("QUERY") or {}
+    if not query_config.get("CHUNK_SIZE"):
+        return 1
+    capacity = psql_pool_capacity(config)
+    return min(query_config.get("MAX_WORKERS") or capacity, capacity)
 
 
 class MultiDriverConnection(DatabaseConnection):
@@ -9,10 +116,69 @@ class MultiDriverConnection(DatabaseConnection):
         self.config = config
         self.psql_driver = SQLConnection()
         self.mongo_driver = MongoConnection()
+        self.mongo_pool_counter = None
 
     def connect(self):
+        pool_config = self.config.get("POOL") or {}
+        # Drivers use an engine or client already set instead of creating
+        # one with the library defaults, so they are only created here when
+        # pool settings are given
+        if pool_config.get("PSQL"):
+            self.psql_driver.engine = create_engine(
+                psql_url(self.config["PSQL"]), **pool_config["PSQL"]
+            )
+        if pool_config.get("MONGO"):
+            options = {
+                **mongo_client_options(self.config["MONGO"]),
+                **pool_config["MONGO"],
+            }
+            self.mongo_pool_counter = MongoPoolCounter()
+            self.mongo_driver.client = MongoClient(
+                event_listeners=[self.mongo_pool_counter], **options
+            )
         self.mongo_driver.connect(self.config["MONGO"])
-        self.psql_driver.connect(self.config["PSQL"])
+        # Scoped sessions give each thread its own session (and connection
+        # from the engine pool), so PSQL reads can run concurrently.
+        self.psql_driver.connect(self.config["PSQL"], use_scoped=True)
+        if pool_config.get("WARM_UP"):
+            self.warm_up()
+
+    def warm_up(self):
+        """Open the connections of the pools before the first batch.
+
+        PSQL opens as many connections as the pool keeps, Mongo checks the
+        server is reachable (the client keeps minPoolSize connections).
+        """
+        engine = self.psql_driver.engine
+        connections = [engine.connect() for _ in range(engine.pool.size())]
+        for connection in connections:
+            connection.close()
+        self.mongo_driver.client.admin.command("ping")
+
+    def pool_status(self) -> dict:
+        """Utilization of PSQL and Mongo connection pools."""
+        pool = self.psql_driver.engine.pool
+        status = {
+            "psql": {
+                "size": pool.size(),
+                "checked_in": pool.checkedin(),
+                "checked_out": pool.checkedout(),
+                "overflow": pool.overflow(),
+            }
+        }
+        if self.mongo_pool_counter is not None:
+            status["mongo"] = {
+                "max_size": (
+                    self.mongo_driver.client.options.pool_options.max_pool_size
+                ),
+                "open": self.mongo_pool_counter.open,
+                "checked_out": self.mongo_pool_counter.checked_out,
+            }
+        return status
+
+    def remove_session(self):
+        """Release the PSQL session bound to the current thread."""
+        self.psql_driver.session.remove()
 
     def create_db(self):
         self.mongo_driver.create_db()
@@ -24,6 +190,15 @@ class MultiDriverConnection(DatabaseConnection):
         self.psql_driver.session.close()
 
     def query(self, query_class=None, *args, **kwargs):
+        query_config = self.config.get("QUERY", {})
+        kwargs.setdefault("chunk_size", query_config.get("CHUNK_SIZE"))
+        max_workers = query_config.get("MAX_WORKERS")
+        if kwargs.get("engine") == "psql":
+            max_workers = psql_read_connections(self.config)
+        kwargs.setdefault("max_workers", max_workers)
+        kwargs.setdefault(
+            "unnest_threshold", query_config.get("UNNEST_THRESHOLD")
+        )
         return MultiQuery(
             self.psql_driver, self.mongo_driver, query_class, *args, **kwargs
         )
@@ -1,10 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 from db_plugins.db.generic import BaseQuery
 from db_plugins.db.mongo import MongoConnection
 from db_plugins.db.sql import SQLConnection
+from pymongo import UpdateOne
 from typing import List
-from sqlalchemy import and_
+from sqlalchemy import and_, func, select, Integer
+from sqlalchemy.dialects.postgresql import ARRAY, insert
 from sqlalchemy.sql.expression import bindparam
 
+import io
+import numpy as np
+import pandas as pd
+
 import db_plugins.db.mongo.models as mongo_models
 import db_plugins.db.sql.models as psql_models
 
@@ -28,6 +35,36 @@ MODELS = {
 }
 
 
+# Defaults of these Mongo fields are only written when a document is
+# created, so values added later by other steps are not overwritten
+MONGO_INSERT_ONLY_FIELDS = ["magstats", "features", "probabilities", "xmatch"]
+
+
+def mongo_upsert(
+    model, document: dict, _filter: dict, raw_fields: List[str] = None
+) -> UpdateOne:
+    """Upsert of a document built with its Mongo model.
+
+    The model adds derived fields (like `loc`) and defaults, and leaves out
+    keys that are not fields of it, except `raw_fields` that are set as
+    given. `_id` is taken from the filter.
+    """
+    document_model = model(**document)
+    document_model.pop("_id", None)
+    for field in raw_fields or []:
+        if field in document:
+            document_model[field] = document[field]
+    on_insert = {
+        field: document_model.pop(field)
+        for field in MONGO_INSERT_ONLY_FIELDS
+        if field in document_model and field not in document
+    }
+    update = {"$set": dict(document_model)}
+    if on_insert:
+        update["$setOnInsert"] = on_insert
+    return UpdateOne(_filter, update, upsert=True)
+
+
 def get_model(engine: str, model: str):
     try:
         if engine not in MODELS.keys():
@@ -43,7 +80,23 @@ def get_model(engine: str, model: str):
         raise Exception(f"Indicates model on query() method: {e}")
 
 
-def filter_to_psql(model: object, filter_by: dict):
+def unnest_values(model: object, attribute: str, values: list):
+    """Select over the values of a list sent as a single array parameter.
+
+    The statement is the same for any number of values, so PSQL can join
+    against it (instead of planning a long IN list on every batch).
+    """
+    values = bindparam(
+        f"{attribute}_values",
+        value=list(values),
+        type_=ARRAY(model.__table__.c[attribute].type),
+    )
+    return select([func.unnest(values)])
+
+
+def filter_to_psql(
+    model: object, filter_by: dict, unnest_threshold: int = None
+):
     filters = []
     for attribute, _filter in filter_by.items():
         if not isinstance(_filter, dict):
@@ -51,7 +104,10 @@ def filter_to_psql(model: object, filter_by: dict):
             filters.append(f)
         elif "$in" in _filter:
             attribute = "oid" if attribute == "aid" else attribute
-            f = getattr(model, attribute).in_(_filter["$in"])
+            values = _filter["$in"]
+            if unnest_threshold and len(values) > unnest_threshold:
+                values = unnest_values(model, attribute, values)
+            f = getattr(model, attribute).in_(values)
             filters.append(f)
     if len(filters) == 1:
         return filters[0]
@@ -82,6 +138,55 @@ def update_to_psql(model: object, filter_by: List[dict]):
         return and_(*filters)
 
 
+def split_in_filter(filter_by: dict, chunk_size: int = None) -> List[dict]:
+    """Split a filter with a long $in list in filters of shorter lists.
+
+    Only the first $in of the filter is split, in lists of at most
+    `chunk_size` values. Filters without a long $in are returned as is.
+    """
+    for attribute, _filter in filter_by.items():
+        if not isinstance(_filter, dict) or "$in" not in _filter:
+            continue
+        values = list(_filter["$in"])
+        if not chunk_size or len(values) <= chunk_size:
+            break
+        return [
+            {
+                **filter_by,
+                attribute: {**_filter, "$in": values[i : i + chunk_size]},
+            }
+            for i in range(0, len(values), chunk_size)
+        ]
+    return [filter_by]
+
+
+def to_copy_buffer(data: pd.DataFrame, table) -> io.StringIO:
+    """Write a DataFrame as CSV for a PSQL COPY on a table.
+
+    Only columns of the table are written. Integer columns with missing
+    values (float or object in pandas) are written as integers. Missing
+    values are written as \\N.
+    """
+    columns = [c for c in table.columns if c.name in data.columns]
+    data = data[[c.name for c in columns]]
+    for column in columns:
+        values = data[column.name]
+        if not isinstance(column.type, Integer):
+            continue
+        if values.dtype.kind == "f":
+            data[column.name] = values.astype("Int64")
+        elif values.dtype.kind == "O":
+            data[column.name] = pd.Series(
+                [None if pd.isna(v) else int(v) for v in values.values],
+                index=data.index,
+                dtype=object,
+            )
+    buffer = io.StringIO()
+    data.to_csv(buffer, index=False, header=False, na_rep="\\N")
+    buffer.seek(0)
+    return buffer
+
+
 class MultiQuery(BaseQuery):
     def __init__(
         self,
@@ -95,6 +200,11 @@ class MultiQuery(BaseQuery):
         self.psql = psql_driver
         self.mongo = mongo_driver
         self.engine = kwargs.get("engine", "mongo")
+        # Long $in lists are read in chunks of this size, concurrently
+        self.chunk_size = kwargs.get("chunk_size")
+        self.max_workers = kwargs.get("max_workers")
+        # Longer $in lists are sent to PSQL as one array parameter
+        self.unnest_threshold = kwargs.get("unnest_threshold")
 
     def check_exists(self, model, filter_by):
         """Check if a model exists in the database."""
@@ -128,6 +238,108 @@ class MultiQuery(BaseQuery):
             )
             return self.psql.engine.execute(statement, to_update)
 
+    def bulk_upsert(
+        self,
+        to_upsert: List[dict],
+        filter_by: List[dict] = None,
+        update_fields: List[str] = None,
+        raw_fields: List[str] = None,
+    ):
+        """Insert or update many documents in a single request.
+
+        On mongo, documents matching its filter are updated, the rest are
+        inserted (see `mongo_upsert`, `raw_fields` are kept even if they
+        are not fields of the model). Operations are unordered, so one
+        failure doesn't stop the others.
+
+        On psql rows are inserted with ON CONFLICT over the primary key of
+        the table: DO UPDATE of `update_fields`, or DO NOTHING if they are
+        not given. `filter_by` is not used.
+        """
+        model = get_model(self.engine, self.model)
+
+        if self.engine == "mongo":
+            operations = [
+                mongo_upsert(model, document, _filter, raw_fields)
+                for document, _filter in zip(to_upsert, filter_by)
+            ]
+            return self._mongo_collection(model).bulk_write(
+                operations, ordered=False
+            )
+        elif self.engine == "psql":
+            if len(to_upsert) == 0:
+                return
+            table = model.__table__
+            columns = [k for k in to_upsert[0].keys() if k in table.columns]
+            rows = [{k: x[k] for k in columns} for x in to_upsert]
+            statement = insert(table)
+            primary_key = [c.name for c in table.primary_key.columns]
+            if update_fields:
+                statement = statement.on_conflict_do_update(
+                    index_elements=primary_key,
+                    set_={
+                        field: statement.excluded[field]
+                        for field in update_fields
+                        if field in columns
+                    },
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=primary_key
+                )
+            return self.psql.engine.execute(statement, rows)
+
+    def bulk_copy(self, data: pd.DataFrame, staging: bool = False):
+        """Load a DataFrame with COPY ... FROM STDIN (only PSQL).
+
+        With staging, rows are copied to a temporary table first and then
+        inserted skipping the ones that conflict with existing rows.
+        """
+        if self.engine != "psql":
+            raise NotImplementedError()
+        if len(data) == 0:
+            return
+        table = get_model(self.engine, self.model).__table__
+        buffer = to_copy_buffer(data, table)
+        columns = ", ".join(
+            f'"{c.name}"' for c in table.columns if c.name in data.columns
+        )
+
+        def copy_statement(target):
+            return (
+                f"COPY {target} ({columns}) "
+                "FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+            )
+
+        connection = self.psql.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if staging:
+                staging_table = f'"{table.name}_staging"'
+                cursor.execute(
+                    f"CREATE TEMP TABLE {staging_table} "
+                    f'(LIKE "{table.name}" INCLUDING DEFAULTS) ON COMMIT DROP'
+                )
+                cursor.copy_expert(copy_statement(staging_table), buffer)
+                cursor.execute(
+                    f'INSERT INTO "{table.name}" ({columns}) '
+                    f"SELECT {columns} FROM {staging_table} "
+                    "ON CONFLICT DO NOTHING"
+                )
+            else:
+                cursor.copy_expert(copy_statement(f'"{table.name}"'), buffer)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    def _mongo_collection(self, model):
+        query = self.mongo.query()
+        query.init_collection(model)
+        return query.collection
+
     def paginate(self, page=1, per_page=10, count=True):
         """Return a pagination object from this query."""
         raise NotImplementedError()
@@ -142,6 +354,12 @@ class MultiQuery(BaseQuery):
 
     def find_all(self, filter_by={}, paginate=False):
         """Retrieve all items from the result of this query."""
+        chunks = self._map_chunks(
+            lambda _filter: self._find_all(_filter, paginate), filter_by
+        )
+        return [x for chunk in chunks for x in chunk]
+
+    def _find_all(self, filter_by={}, paginate=False):
         model = get_model(self.engine, self.model)
         if self.engine == "mongo":
             cursor = self.mongo.query().find_all(
@@ -149,7 +367,7 @@ class MultiQuery(BaseQuery):
             )
             return [x for x in cursor]
         elif self.engine == "psql":
-            filter_by = filter_to_psql(model, filter_by)
+            filter_by = filter_to_psql(model, filter_by, self.unnest_threshold)
             response = self.psql.query().find_all(
                 model=model, filter_by=filter_by, paginate=paginate
             )
@@ -158,6 +376,85 @@ class MultiQuery(BaseQuery):
                 del x["_sa_instance_state"]
             return response
 
+    def find_dataframe(
+        self, filter_by={}, columns: List[str] = None, batch_size: int = None
+    ):
+        """Retrieve all items of this query as a DataFrame.
+
+        On psql the select is done with SQLAlchemy Core, so rows are read as
+        tuples without building ORM instances. `columns` selects only a
+        subset of the columns of the table.
+
+        On mongo, when `columns` are given they are used as projection and
+        documents are decoded column by column while iterating the cursor
+        (fetching `batch_size` documents on each round trip), so the list of
+        documents is never held in memory. Missing fields are NaN.
+        """
+        chunks = self._map_chunks(
+            lambda _filter: self._find_dataframe(_filter, columns, batch_size),
+            filter_by,
+        )
+        if len(chunks) == 1:
+            return chunks[0]
+        return pd.concat(chunks, ignore_index=True)
+
+    def _find_dataframe(
+        self, filter_by={}, columns: List[str] = None, batch_size: int = None
+    ):
+        model = get_model(self.engine, self.model)
+        if self.engine == "mongo":
+            if columns is None:
+                return pd.DataFrame(
+                    self._find_all(filter_by=filter_by, paginate=False)
+                )
+            projection = {column: 1 for column in columns}
+            if "_id" not in projection:
+                projection["_id"] = 0
+            cursor = self._mongo_collection(model).find(filter_by, projection)
+            if batch_size:
+                cursor = cursor.batch_size(batch_size)
+            values = {column: [] for column in columns}
+            for document in cursor:
+                for column in columns:
+                    values[column].append(document.get(column, np.nan))
+            return pd.DataFrame(values, columns=columns)
+        elif self.engine == "psql":
+            table = model.__table__
+            if columns is None:
+                statement = select([table])
+            else:
+                statement = select([table.c[c] for c in columns])
+            where_clause = filter_to_psql(
+                model, filter_by, self.unnest_threshold
+            )
+            if len(filter_by):
+                statement = statement.where(where_clause)
+            result = self.psql.session.execute(statement)
+            return pd.DataFrame.from_records(
+                result.fetchall(), columns=list(result.keys())
+            )
+
+    def _map_chunks(self, function, filter_by: dict) -> list:
+        """Apply a read function over each chunk of a filter.
+
+        Chunks are read concurrently and results are returned in the order
+        of the chunks. A filter without chunks is read in the calling thread.
+        """
+        filters = split_in_filter(filter_by, self.chunk_size)
+        if len(filters) == 1:
+            return [function(filters[0])]
+
+        def read_chunk(_filter):
+            try:
+                return function(_filter)
+            finally:
+                # Each worker thread gets its own PSQL scoped session
+                if self.engine == "psql":
+                    self.psql.session.remove()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(read_chunk, filters))
+
     def find_one(self, filter_by={}, model=None, **kwargs):
         """Retrieve only one item from the result of this query.
         Returns None if result is empty.
@@ -15,7 +15,11 @@ from ingestion_step.utils.constants import (
 )
 from typing import List
 from lc_correction.compute import (
-    apply_mag_stats,
+    DISTANCE_THRESHOLD,
+    SCORE_THRESHOLD,
+    CHINR_THRESHOLD,
+    SHARPNR_MAX,
+    SHARPNR_MIN,
     get_flag_reference,
     get_flag_saturation,
     do_dmdt,
@@ -23,14 +27,17 @@ from lc_correction.compute import (
     apply_objstats_from_magstats,
 )
 
+# Catalogs retrieved by oid on each batch
+PSQL_CATALOGS = ["Ss_ztf", "Reference", "Ps1_ztf", "Gaia_ztf", "MagStats"]
+
 
 # TEMPORAL CODE
 def get_catalog(
     aids: List[str or int], table: str, driver: MultiDriverConnection
 ):
     filter_by = {"aid": {"$in": aids}}
-    catalog = driver.query(table, engine="psql").find_all(
-        filter_by=filter_by, paginate=False
+    catalog = driver.query(table, engine="psql").find_dataframe(
+        filter_by=filter_by
     )
     catalog = pd.DataFrame(catalog)
     catalog.replace({np.nan: None}, inplace=True)
@@ -43,26 +50,13 @@ def preprocess_dataquality(detections: pd.DataFrame):
     return dataquality
 
 
-def get_dataquality(candids: List[int], driver: MultiDriverConnection):
-    filter_by = {"candid": {"$in": candids}}
-    query = driver.query("Dataquality", engine="psql").find_all(
-        filter_by=filter_by, paginate=False
-    )
-    return pd.DataFrame(query, columns=DATAQUALITY_KEYS)
-
-
 def insert_dataquality(
     dataquality: pd.DataFrame, driver: MultiDriverConnection
 ):
-    # Not inserting twice
-    candids = dataquality["candid"].unique().tolist()
-    old_dataquality = get_dataquality(candids, driver)
-    already_on_db = dataquality["candid"].isin(old_dataquality["candid"])
-
-    dataquality = dataquality[~already_on_db]
-    dataquality.replace({np.nan: None}, inplace=True)
-    dict_dataquality = dataquality.to_dict("records")
-    driver.query("Dataquality", engine="psql").bulk_insert(dict_dataquality)
+    # Not inserting twice: rows already on database are skipped by PSQL
+    driver.query("Dataquality", engine="psql").bulk_copy(
+        dataquality, staging=True
+    )
 
 
 def preprocess_ss(
@@ -88,7 +82,7 @@ def insert_ss(metadata: pd.DataFrame, driver: MultiDriverConnection):
     if len(to_insert) > 0:
         to_insert.replace({np.nan: None}, inplace=True)
         dict_to_insert = to_insert.to_dict("records")
-        driver.query("Ss_ztf", engine="psql").bulk_insert(dict_to_insert)
+        driver.query("Ss_ztf", engine="psql").bulk_upsert(dict_to_insert)
 
 
 def preprocess_reference(metadata: pd.DataFrame, detections: pd.DataFrame):
@@ -119,7 +113,7 @@ def insert_reference(metadata: pd.DataFrame, driver: MultiDriverConnection):
         to_insert.replace({np.nan: None}, inplace=True)
         to_insert = to_insert.astype(object).where(pd.notnull(to_insert), None)
         dict_to_insert = to_insert.to_dict("records")
-        driver.query("Reference", engine="psql").bulk_insert(dict_to_insert)
+        driver.query("Reference", engine="psql").bulk_upsert(dict_to_insert)
 
 
 def preprocess_ps1(metadata: pd.DataFrame, detections: pd.DataFrame):
@@ -167,28 +161,16 @@ def preprocess_ps1(metadata: pd.DataFrame, detections: pd.DataFrame):
 
 
 def insert_ps1(metadata: pd.DataFrame, driver: MultiDriverConnection):
+    # New rows and rows whose unique flags changed
     new_metadata = metadata["new"].astype(bool)
-    to_insert = metadata[new_metadata]
-    to_update = metadata[~new_metadata]
-
-    if len(to_insert) > 0:
-        to_insert.replace({np.nan: None}, inplace=True)
-        dict_to_insert = to_insert.to_dict("records")
-        driver.query("Ps1_ztf", engine="psql").bulk_insert(dict_to_insert)
-
-    if len(to_update) > 0:
-        updates = to_update[
-            to_update.update1 | to_update.update2 | to_update.update3
-        ]
-        if len(updates) > 0:
-            updates.replace({np.nan: None}, inplace=True)
-            oids = updates["oid"].values
-            updates = updates[["oid", "unique1", "unique2", "unique3"]]
-            dict_updates = updates.to_dict("records")
-            filter_by = [{"_id": x} for x in oids]
-            driver.query("Ps1_ztf", engine="psql").bulk_update(
-                dict_updates, filter_by=filter_by
-            )
+    updates = metadata.update1 | metadata.update2 | metadata.update3
+    to_upsert = metadata[new_metadata | updates.astype(bool)]
+    if len(to_upsert) > 0:
+        to_upsert.replace({np.nan: None}, inplace=True)
+        dict_to_upsert = to_upsert.to_dict("records")
+        driver.query("Ps1_ztf", engine="psql").bulk_upsert(
+            dict_to_upsert, update_fields=["unique1", "unique2", "unique3"]
+        )
 
 
 def preprocess_gaia(
@@ -245,22 +227,14 @@ def preprocess_gaia(
 
 
 def insert_gaia(metadata: pd.DataFrame, driver: MultiDriverConnection):
+    # New rows and rows whose unique flag changed
     new_metadata = metadata["new"].astype(bool)
-    to_insert = metadata[new_metadata]
-    to_update = metadata[~new_metadata]
-    if len(to_insert) > 0:
-        dict_to_insert = to_insert.to_dict("records")
-        driver.query("Gaia_ztf", engine="psql").bulk_insert(dict_to_insert)
-    if len(to_update) > 0:
-        updates = to_update[to_update.update1]
-        if len(updates) > 0:
-            updates = updates[["oid", "unique1"]]
-            oids = updates["oid"].values
-            dict_updates = updates.to_dict("records")
-            filter_by = [{"_id": x} for x in oids]
-            driver.query("Gaia_ztf", engine="psql").bulk_update(
-                dict_updates, filter_by=filter_by
-            )
+    to_upsert = metadata[new_metadata | metadata["update1"].astype(bool)]
+    if len(to_upsert) > 0:
+        dict_to_upsert = to_upsert.to_dict("records")
+        driver.query("Gaia_ztf", engine="psql").bulk_upsert(
+            dict_to_upsert, update_fields=["unique1"]
+        )
 
 
 def do_flags(detections: pd.DataFrame, reference: pd.DataFrame):
@@ -286,34 +260,303 @@ def do_flags(detections: pd.DataFrame, reference: pd.DataFrame):
 
 
 def do_dmdt_df(magstats, non_dets, dt_min=0.5):
-    magstats.set_index(["objectId", "fid"], inplace=True, drop=True)
     non_dets_magstats = non_dets.join(
-        magstats, on=["objectId", "fid"], how="inner", rsuffix="_stats"
+        magstats.set_index(["oid", "fid"]),
+        on=["oid", "fid"],
+        how="inner",
+        rsuffix="_stats",
     )
+    non_dets_magstats["objectId"] = non_dets_magstats["oid"]
     responses = []
     for i, g in non_dets_magstats.groupby(["objectId", "fid"]):
         response = do_dmdt(g)
         response["oid"] = i[0]
         response["fid"] = i[1]
         responses.append(response)
-    result = pd.DataFrame(responses)
-    magstats.reset_index(inplace=True)
-    return result
+    return pd.DataFrame(responses)
 
 
 def compute_dmdt(light_curves: dict, magstats: pd.DataFrame):
     if len(light_curves["non_detections"]) == 0:
         return pd.DataFrame()
-    non_detections = light_curves["non_detections"]
-    non_detections["objectId"] = non_detections["oid"]
-    if "index" in non_detections.columns:
-        non_detections.drop(columns=["index"], inplace=True)
-        non_detections.reset_index(drop=True, inplace=True)
-    magstats["objectId"] = magstats["oid"]
-    dmdt = do_dmdt_df(magstats, non_detections)
-    non_detections.drop(columns=["objectId"], inplace=True)
-    magstats.drop(columns=["objectId"], inplace=True)
-    return dmdt
+    return do_dmdt_df(magstats, light_curves["non_detections"])
+
+
+def _first_positions(codes: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """Position of the first row with the smallest value of each group.
+
+    Same row as `idxmin` over each group (NaN values are last). `codes` are
+    the group number of each row, from 0 to the number of groups - 1.
+    """
+    order = np.lexsort((values, codes))
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    return order[starts]
+
+
+def _first_detection_flags(
+    detections: pd.DataFrame, first: np.ndarray
+) -> dict:
+    """Flags of `apply_mag_stats` taken from the first detections."""
+
+    def first_values(column):
+        return detections[column].values[first].astype(float)
+
+    distnr = first_values("distnr")
+    distpsnr1 = first_values("distpsnr1")
+    chinr = first_values("chinr")
+    sharpnr = first_values("sharpnr")
+    near_ztf = (0 <= distnr) & (distnr < DISTANCE_THRESHOLD)
+    near_ps1 = (0 <= distpsnr1) & (distpsnr1 < DISTANCE_THRESHOLD)
+    stellar_ps1 = first_values("sgscore1") > SCORE_THRESHOLD
+    stellar_ztf = (
+        (chinr < CHINR_THRESHOLD)
+        & (SHARPNR_MIN < sharpnr)
+        & (sharpnr < SHARPNR_MAX)
+    )
+    return {
+        "corrected": detections["corrected"].values[first],
+        "nearZTF": near_ztf,
+        "nearPS1": near_ps1,
+        # apply_mag_stats stores each stellar flag under the other name
+        "stellarZTF": stellar_ps1,
+        "stellarPS1": stellar_ztf,
+        "stellar": (near_ztf & near_ps1 & stellar_ps1)
+        | (near_ztf & ~near_ps1 & stellar_ztf),
+    }
+
+
+def magstats_df(detections: pd.DataFrame) -> pd.DataFrame:
+    """Magnitude statistics of each (oid, fid) of the detections.
+
+    Vectorized version of grouping by oid and fid (without sorting) and
+    applying `apply_mag_stats`, with the same columns and values. Values
+    of the first and last detections are taken from their rows and the
+    rest are grouped reductions over all rows.
+    """
+    groups = detections.groupby(["oid", "fid"], sort=False)
+    keys = groups.size().index
+    response = keys.to_frame(index=False)
+    if len(detections) == 0:
+        return response
+    codes = groups.ngroup().values
+    mjd = detections["mjd"].values.astype(float)
+    first = _first_positions(codes, mjd)
+    last = _first_positions(codes, -mjd)
+
+    for name, values in _first_detection_flags(detections, first).items():
+        response[name] = values
+    n_groups = len(keys)
+    response["ndet"] = np.bincount(codes, minlength=n_groups)
+    dubious = detections["dubious"].eq(True).values
+    response["ndubious"] = np.bincount(
+        codes, weights=dubious, minlength=n_groups
+    ).astype(int)
+    rfid = detections["rfid"].groupby(codes).nunique()
+    response["nrfid"] = rfid.reindex(range(n_groups), fill_value=0).values
+
+    names = {
+        "magpsf": ("magpsf", "sigmapsf"),
+        "magpsf_corr": ("magpsf_corr", "sigmapsf_corr"),
+        "magap": ("magap", "sigmap"),
+    }
+    for column, (prefix, sigma) in names.items():
+        values = pd.Series(detections[column].values.astype(float))
+        grouped = values.groupby(codes)
+        response[f"{prefix}_mean"] = grouped.mean().values
+        response[f"{prefix}_median"] = grouped.median().values
+        response[f"{prefix}_max"] = grouped.max().values
+        response[f"{prefix}_min"] = grouped.min().values
+        response[sigma] = grouped.std().values
+        response[f"{prefix}_first"] = values.values[first]
+        if column == "magpsf":
+            response["sigmapsf_first"] = (
+                detections["sigmapsf"].values[first].astype(float)
+            )
+        response[f"{prefix}_last"] = values.values[last]
+    response["first_mjd"] = mjd[first]
+    response["last_mjd"] = mjd[last]
+    return response
+
+
+def _merge_moments(count, mean, m2, new_count, new_mean, new_m2):
+    """Mean and sum of squared deviations of the union of two samples.
+
+    Pairwise update of Chan et al. A sample without values has NaN mean.
+    """
+    total = count + new_count
+    delta = np.nan_to_num(new_mean - mean)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        merged_mean = np.where(
+            count == 0, new_mean, mean + delta * new_count / total
+        )
+        merged_m2 = (
+            np.nan_to_num(m2)
+            + np.nan_to_num(new_m2)
+            + np.nan_to_num(delta**2 * count * new_count / total)
+        )
+    return merged_mean, merged_m2
+
+
+def _merge_magstats(stored: pd.DataFrame, detections: pd.DataFrame):
+    """Stored magstats updated with the new detections of each (oid, fid).
+
+    Counts, means, deviations, extremes and first and last values are
+    merged from the stored row and the new detections. Medians, the number
+    of reference ids and the flags of the first detection are taken from
+    the whole light curve, magap statistics are not stored and left out.
+    """
+    groups = detections.groupby(["oid", "fid"], sort=False)
+    keys = groups.size().index
+    stored = stored.reindex(keys)
+    codes = groups.ngroup().values
+    n_groups = len(keys)
+    new = detections["new"].values.astype(bool)
+    mjd = detections["mjd"].values.astype(float)
+    first = _first_positions(codes, mjd)
+    # Every (oid, fid) merged has new detections, so these are in order
+    new_first = _first_positions(codes[new], mjd[new])
+    new_last = _first_positions(codes[new], -mjd[new])
+    new_first_mjd = mjd[new][new_first]
+    new_last_mjd = mjd[new][new_last]
+    # Ties keep the stored (older) detection, like `magstats_df`
+    take_first = new_first_mjd < stored["first_mjd"].values
+    take_last = new_last_mjd > stored["last_mjd"].values
+
+    response = keys.to_frame(index=False)
+    for name, values in _first_detection_flags(detections, first).items():
+        response[name] = values
+    response["ndet"] = stored["ndet"].values + np.bincount(
+        codes[new], minlength=n_groups
+    )
+    dubious = detections["dubious"].eq(True).values & new
+    response["ndubious"] = stored["ndubious"].values + np.bincount(
+        codes, weights=dubious, minlength=n_groups
+    ).astype(int)
+    rfid = detections["rfid"].groupby(codes).nunique()
+    response["nrfid"] = rfid.reindex(range(n_groups), fill_value=0).values
+
+    names = {
+        "magpsf": ("magpsf", "sigmapsf"),
+        "magpsf_corr": ("magpsf_corr", "sigmapsf_corr"),
+    }
+    for column, (prefix, sigma) in names.items():
+        values = detections[column].values.astype(float)
+        count = np.bincount(
+            codes, weights=~new & ~np.isnan(values), minlength=n_groups
+        )
+        mean = stored[f"{prefix}_mean"].values
+        m2 = stored[sigma].values ** 2 * (count - 1)
+        grouped = pd.Series(values[new]).groupby(codes[new])
+        new_count = grouped.count().values
+        new_m2 = grouped.var(ddof=0).values * new_count
+        mean, m2 = _merge_moments(
+            count, mean, m2, new_count, grouped.mean().values, new_m2
+        )
+        total = count + new_count
+        response[f"{prefix}_mean"] = mean
+        response[f"{prefix}_median"] = (
+            pd.Series(values).groupby(codes).median().values
+        )
+        response[f"{prefix}_max"] = np.fmax(
+            stored[f"{prefix}_max"].values, grouped.max().values
+        )
+        response[f"{prefix}_min"] = np.fmin(
+            stored[f"{prefix}_min"].values, grouped.min().values
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            response[sigma] = np.where(
+                total > 1, np.sqrt(m2 / (total - 1)), np.nan
+            )
+        response[f"{prefix}_first"] = np.where(
+            take_first,
+            values[new][new_first],
+            stored[f"{prefix}_first"].values,
+        )
+        if column == "magpsf":
+            response["sigmapsf_first"] = (
+                detections["sigmapsf"].values[first].astype(float)
+            )
+        response[f"{prefix}_last"] = np.where(
+            take_last,
+            values[new][new_last],
+            stored[f"{prefix}_last"].values,
+        )
+    response["first_mjd"] = np.where(
+        take_first, new_first_mjd, stored["first_mjd"].values
+    )
+    response["last_mjd"] = np.where(
+        take_last, new_last_mjd, stored["last_mjd"].values
+    )
+    return response
+
+
+def reuse_magstats(magstats: pd.DataFrame, detections: pd.DataFrame):
+    """Stored magstats of (oid, fid) that don't need to be computed again.
+
+    A stored row is used if its ndet is the number of detections of the
+    light curve stored before this batch. Without new detections it is
+    reused as it is, fields that are not stored are taken from the first
+    detection of each (oid, fid), except magap statistics. Otherwise it is
+    merged with the new detections (see `_merge_magstats`).
+
+    Returns the reused and merged magstats (same names as `magstats_df`)
+    and a mask of the detections whose (oid, fid) must be computed.
+    """
+    if len(magstats) == 0 or len(detections) == 0:
+        return pd.DataFrame(columns=["oid", "fid"]), np.ones(
+            len(detections), dtype=bool
+        )
+    groups = detections.groupby(["oid", "fid"], sort=False)
+    sizes = groups.size()
+    codes = groups.ngroup().values
+    has_new = np.bincount(
+        codes,
+        weights=detections["new"].values.astype(float),
+        minlength=len(sizes),
+    )
+    stored = magstats.rename(
+        columns={db: name for name, db in MAGSTATS_TRANSLATE.items()}
+    ).set_index(["oid", "fid"])
+    stored = stored[~stored.index.duplicated()].reindex(sizes.index)
+    stored_ndet = pd.to_numeric(stored["ndet"], errors="coerce").values
+    valid = stored_ndet == sizes.values - has_new
+    reuse = valid & (has_new == 0)
+    merge = valid & (has_new > 0)
+    if not valid.any():
+        return pd.DataFrame(columns=["oid", "fid"]), ~valid[codes]
+
+    stored = (
+        stored[list(MAGSTATS_TRANSLATE)]
+        .astype(float)
+        .join(stored[["ndet", "ndubious"]].astype(float))
+    )
+    responses = []
+    if reuse.any():
+        reused = stored.iloc[np.flatnonzero(reuse)]
+        reused = reused.astype({"ndet": int, "ndubious": int})
+        reused.reset_index(inplace=True)
+        # Group codes of the reused rows keep the order of `reused`
+        reused_rows = reuse[codes]
+        reused_detections = detections[reused_rows]
+        reused_codes = codes[reused_rows]
+        first = _first_positions(reused_codes, reused_detections["mjd"].values)
+        for name, values in _first_detection_flags(
+            reused_detections, first
+        ).items():
+            reused[name] = values
+        reused["sigmapsf_first"] = (
+            reused_detections["sigmapsf"].values[first].astype(float)
+        )
+        reused["nrfid"] = (
+            reused_detections["rfid"].groupby(reused_codes).nunique().values
+        )
+        responses.append(reused)
+    if merge.any():
+        merged = stored.iloc[np.flatnonzero(merge)]
+        merged = merged.astype({"ndet": int, "ndubious": int})
+        responses.append(_merge_magstats(merged, detections[merge[codes]]))
+    return pd.concat(responses, ignore_index=True), ~valid[codes]
 
 
 def do_magstats(
@@ -322,56 +565,44 @@ def do_magstats(
     ps1: pd.DataFrame,
     reference: pd.DataFrame,
     version: str,
+    incremental: bool = False,
 ):
     if len(magstats) == 0:
         magstats = pd.DataFrame(columns=["oid", "fid"])
     magstats_index = pd.MultiIndex.from_frame(magstats[["oid", "fid"]])
     detections = light_curves["detections"]
-    ps1.set_index("oid", inplace=True)
-    reference.set_index(["oid", "rfid"], inplace=True)
-    det_ps1 = detections.join(ps1, on="oid", rsuffix="ps1")
-    det_ps1_ref = det_ps1.join(reference, on=["oid", "rfid"], rsuffix="ref")
-    det_ps1_ref.reset_index(inplace=True)
+    # Catalogs are indexed on new frames, they are inserted later
+    det_ps1 = detections.join(ps1.set_index("oid"), on="oid", rsuffix="ps1")
+    det_ps1_ref = det_ps1.join(
+        reference.set_index(["oid", "rfid"]), on=["oid", "rfid"], rsuffix="ref"
+    )
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", category=RuntimeWarning)
-        new_magstats = det_ps1_ref.groupby(["oid", "fid"], sort=False).apply(
-            apply_mag_stats
-        )
-        new_magstats["ndubious"].replace({False: 0}, inplace=True)
-    new_magstats.reset_index(inplace=True)
+        if incremental:
+            # Only (oid, fid) without a matching stored row are computed
+            reused, to_compute = reuse_magstats(magstats, det_ps1_ref)
+            new_magstats = pd.concat(
+                [magstats_df(det_ps1_ref[to_compute]), reused],
+                ignore_index=True,
+            )
+        else:
+            new_magstats = magstats_df(det_ps1_ref)
     new_magstats_index = pd.MultiIndex.from_frame(new_magstats[["oid", "fid"]])
     new_magstats["new"] = ~new_magstats_index.isin(magstats_index)
     new_magstats["step_id_corr"] = version
     new_magstats.drop_duplicates(["oid", "fid"], inplace=True)
-    reference.reset_index(inplace=True)
-    ps1.reset_index(inplace=True)
     return new_magstats
 
 
 def insert_magstats(magstats: pd.DataFrame, driver: MultiDriverConnection):
-    new_magstats = magstats["new"].astype(bool)
-    to_insert = magstats[new_magstats]
-    to_update = magstats[~new_magstats]
-
-    if len(to_insert) > 0:
-        to_insert.replace({np.nan: None}, inplace=True)
-        dict_to_insert = to_insert.to_dict("records")
-        driver.query("MagStats", engine="psql").bulk_insert(dict_to_insert)
-
-    if len(to_update) > 0:
-        to_update.replace({np.nan: None}, inplace=True)
-        to_update.rename(
-            columns={**MAGSTATS_TRANSLATE},
-            inplace=True,
-        )
-        filter_by = [
-            {"_id": x["oid"], "fid": x["fid"]} for i, x in to_update.iterrows()
-        ]
-        to_update = to_update[["oid", "fid"] + MAGSTATS_UPDATE_KEYS]
-        dict_to_update = to_update.to_dict("records")
-        driver.query("MagStats", engine="psql").bulk_update(
-            dict_to_update, filter_by=filter_by
-        )
+    if len(magstats) == 0:
+        return
+    magstats = magstats.replace({np.nan: None})
+    magstats.rename(columns={**MAGSTATS_TRANSLATE}, inplace=True)
+    dict_magstats = magstats.to_dict("records")
+    driver.query("MagStats", engine="psql").bulk_upsert(
+        dict_magstats, update_fields=MAGSTATS_UPDATE_KEYS
+    )
 
 
 def get_last_alert(alerts: pd.DataFrame):
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+from typing import Iterable
+
+
+class PrvCandidatesCache:
+    """Bounded cache with the latest jd already ingested for each oid.
+
+    Every alert of an object repeats its previous candidates, so candidates
+    older than the latest alert already ingested can be dropped before
+    parsing and correcting them. When the cache is full, the least recently
+    used oid is evicted.
+
+    Parameters
+    ----------
+    max_size : int
+        Max number of oids stored.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._marks = OrderedDict()
+
+    def __len__(self):
+        return len(self._marks)
+
+    def __contains__(self, oid):
+        return oid in self._marks
+
+    def get(self, oid):
+        """Get the latest jd ingested of an oid (None if unknown)."""
+        mark = self._marks.get(oid)
+        if mark is not None:
+            self._marks.move_to_end(oid)
+        return mark
+
+    def update(self, oids: Iterable[str], jds: Iterable[float]):
+        """Move forward the marks of oids. Marks never go backwards."""
+        for oid, jd in zip(oids, jds):
+            mark = self._marks.get(oid)
+            self._marks[oid] = jd if mark is None else max(mark, jd)
+            self._marks.move_to_end(oid)
+        while len(self._marks) > self.max_size:
+            self._marks.popitem(last=False)
@@ -1,7 +1,9 @@
 from .base_prv_candidates_strategy import BasePrvCandidatesStrategy
+from ..cache import PrvCandidatesCache
 from typing import List
 from survey_parser_plugins.core import SurveyParser
 
+import numpy as np
 import pandas as pd
 import pickle
 
@@ -71,54 +73,119 @@ class ZTFPreviousCandidatesParser(SurveyParser):
     def parse(cls, messages: List[dict]) -> List[dict]:
         return list(map(cls.parse_message, messages))
 
+    @classmethod
+    def parse_batch(
+        cls,
+        candidates: List[dict],
+        aids: List[str],
+        oids: List[str],
+        parent_candids: List[int],
+    ) -> pd.DataFrame:
+        """Parse many previous candidates at once.
+
+        Same output as `parse_message` for each candidate, but the DataFrame
+        is built column by column.
+
+        Parameters
+        ----------
+        candidates: Previous candidates (detections) as they come in alerts
+        aids: aid of the alert of each candidate
+        oids: oid of the alert of each candidate
+        parent_candids: candid of the alert of each candidate
+
+        Returns A DataFrame with a parsed detection for each candidate
+        -------
+
+        """
+        if len(candidates) == 0:
+            return pd.DataFrame()
+        mapping = cls._generic_alert_message_key_mapping
+        mapped = set(mapping.values())
+        prv_content = pd.DataFrame(
+            {
+                key: [candidate[value] for candidate in candidates]
+                for key, value in mapping.items()
+            }
+        )
+        prv_content["extra_fields"] = [
+            {k: v for k, v in candidate.items() if k not in mapped}
+            for candidate in candidates
+        ]
+        # inclusion of extra attributes
+        prv_content["oid"] = oids
+        prv_content["aid"] = aids
+        prv_content["tid"] = cls._source
+        # attributes modification
+        prv_content["mjd"] = prv_content["mjd"] - 2400000.5
+        prv_content["isdiffpos"] = np.where(
+            prv_content["isdiffpos"].isin(["t", "1"]), 1, -1
+        )
+        prv_content["parent_candid"] = parent_candids
+        e_radec = prv_content["fid"].map(cls._celestial_errors)
+        prv_content["e_ra"] = e_radec
+        prv_content["e_dec"] = e_radec
+        return prv_content
+
 
 class ZTFPrvCandidatesStrategy(BasePrvCandidatesStrategy):
+    def __init__(self, cache: PrvCandidatesCache = None):
+        # Latest jd ingested for each oid, older candidates are skipped
+        self.cache = cache
+
     def process_prv_candidates(self, alerts: pd.DataFrame):
-        detections = {}
+        candidates = []
+        metadata = []
         non_detections = []
-        for index, alert in alerts.iterrows():
-            oid = alert["oid"]
-            tid = alert["tid"]
-            aid = alert["aid"]
-            candid = alert["candid"]
-            if alert["extra_fields"]["prv_candidates"] is not None:
-                prv_candidates = pickle.loads(
-                    alert["extra_fields"]["prv_candidates"]
-                )
-                for prv in prv_candidates:
-                    if prv["candid"] is None:
-                        prv["aid"] = aid
-                        prv["oid"] = oid
-                        prv["tid"] = tid
-                        non_detections.append(prv)
-                    else:
-                        detections.update(
-                            {
-                                prv["candid"]: {
-                                    "objectId": oid,
-                                    "publisher": tid,
-                                    "aid": aid,
-                                    "candidate": prv,
-                                    "parent_candid": candid,
-                                }
-                            }
+        for aid, oid, tid, candid, extra_fields in zip(
+            alerts["aid"].values,
+            alerts["oid"].values,
+            alerts["tid"].values,
+            alerts["candid"].values,
+            alerts["extra_fields"].values,
+        ):
+            if extra_fields["prv_candidates"] is None:
+                continue
+            mark = self.cache.get(oid) if self.cache is not None else None
+            for prv in pickle.loads(extra_fields["prv_candidates"]):
+                if mark is not None and prv["jd"] <= mark:
+                    continue
+                if prv["candid"] is None:
+                    non_detections.append(
+                        (
+                            aid,
+                            tid,
+                            oid,
+                            prv["jd"],
+                            prv["diffmaglim"],
+                            prv["fid"],
                         )
-                del alert["extra_fields"]["prv_candidates"]
-        detections = ZTFPreviousCandidatesParser.parse(
-            list(detections.values())
+                    )
+                else:
+                    candidates.append(prv)
+                    metadata.append((aid, oid, candid))
+            del extra_fields["prv_candidates"]
+        # The same candidate may come in many alerts: keep the last one
+        duplicated = pd.Series(
+            [prv["candid"] for prv in candidates]
+        ).duplicated(keep="last")
+        candidates = [c for c, d in zip(candidates, duplicated) if not d]
+        metadata = [m for m, d in zip(metadata, duplicated) if not d]
+        aids, oids, parent_candids = (
+            zip(*metadata) if len(metadata) else ([], [], [])
         )
-        detections = pd.DataFrame(detections)
-        non_detections = (
-            pd.DataFrame(non_detections)
-            if len(non_detections)
-            else pd.DataFrame(columns=NON_DET_KEYS)
+        detections = ZTFPreviousCandidatesParser.parse_batch(
+            candidates, list(aids), list(oids), list(parent_candids)
+        )
+        non_detections = pd.DataFrame(
+            non_detections,
+            columns=["aid", "tid", "oid", "jd", "diffmaglim", "fid"],
         )
-
         if len(non_detections):
-            non_detections.rename({"objectId": "oid"}, inplace=True)
             non_detections["mjd"] = non_detections["jd"] - 2400000.5
             non_detections = non_detections[NON_DET_KEYS]
             non_detections = non_detections.drop_duplicates(
                 ["oid", "fid", "mjd"]
             )
+        else:
+            non_detections = pd.DataFrame(columns=NON_DET_KEYS)
         return detections, non_detections
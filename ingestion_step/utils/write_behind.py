@@ -0,0 +1,134 @@
+from typing import Callable, Hashable, Iterable
+
+import pandas as pd
+import queue
+import threading
+import time
+
+# Queued by `close` to write what's left and stop the writer
+_STOP = object()
+
+
+class WriteBehindBuffer:
+    """Buffer of frames to insert, written by a background thread.
+
+    Frames with the same name are concatenated and written together when
+    the buffered rows reach `max_rows` or the oldest frame is `max_age`
+    seconds old. The queue between the step and the writer is bounded, so
+    the step blocks when writes fall behind.
+
+    Keys of the rows (e.g. aids) are kept until they are written, so the
+    step can flush before reading data that is still in the buffer.
+
+    A failed write drops its frames and is raised on the step thread by the
+    next `put`, `flush` or `close`, so offsets of the lost rows are never
+    committed.
+
+    Parameters
+    ----------
+    write: Function called with the name and the frame to write
+    max_rows: Number of buffered rows that triggers a write
+    max_age: Seconds a frame can wait before a write
+    queue_size: Max number of frames waiting for the writer
+    """
+
+    def __init__(
+        self,
+        write: Callable[[Hashable, pd.DataFrame], None],
+        max_rows: int = 10000,
+        max_age: float = 5.0,
+        queue_size: int = 100,
+    ):
+        self.write = write
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._pending_keys = {}
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, name: Hashable, frame: pd.DataFrame, keys: Iterable):
+        """Add a frame to write. Blocks while the queue is full."""
+        self._raise_error()
+        with self._lock:
+            for key in keys:
+                self._pending_keys[key] = self._pending_keys.get(key, 0) + 1
+        self._queue.put((name, frame, list(keys)))
+
+    def is_pending(self, keys: Iterable) -> bool:
+        """Whether any of the keys has rows not written yet."""
+        with self._lock:
+            return any(key in self._pending_keys for key in keys)
+
+    def flush(self):
+        """Write everything buffered and wait until it's done."""
+        try:
+            if self._thread.is_alive():
+                done = threading.Event()
+                self._queue.put((None, None, done))
+                done.wait()
+        finally:
+            self._raise_error()
+
+    def close(self):
+        """Write everything buffered and stop the writer thread.
+
+        It can be called more than once.
+        """
+        if self._thread.is_alive():
+            self._queue.put((None, None, _STOP))
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("Write-behind write failed") from self._error
+
+    def _run(self):
+        frames = {}
+        keys = []
+        n_rows = 0
+        oldest = None
+        while True:
+            timeout = None
+            if oldest is not None:
+                timeout = max(0.0, oldest + self.max_age - time.monotonic())
+            try:
+                name, frame, item_keys = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                name, frame, item_keys = None, None, None
+            if frame is not None:
+                frames.setdefault(name, []).append(frame)
+                keys.extend(item_keys)
+                n_rows += len(frame)
+                oldest = oldest or time.monotonic()
+            stop = item_keys is _STOP
+            flush_request = stop or isinstance(item_keys, threading.Event)
+            expired = (
+                oldest is not None
+                and time.monotonic() - oldest >= self.max_age
+            )
+            if flush_request or expired or n_rows >= self.max_rows:
+                self._write_all(frames, keys)
+                frames, keys, n_rows, oldest = {}, [], 0, None
+            if stop:
+                return
+            if flush_request:
+                item_keys.set()
+
+    def _write_all(self, frames: dict, keys: list):
+        try:
+            for name, name_frames in frames.items():
+                self.write(name, pd.concat(name_frames, ignore_index=True))
+        except Exception as e:
+            # Raised on the step thread on the next put, flush or close
+            self._error = e
+        finally:
+            # Failed rows are not pending either, they are dropped
+            with self._lock:
+                for key in keys:
+                    self._pending_keys[key] -= 1
+                    if self._pending_keys[key] == 0:
+                        del self._pending_keys[key]
@@ -1,6 +1,28 @@
 import os
 from schema import SCHEMA
 
+
+def parse_flag(value):
+    """Only "1", "true" and "yes" enable a boolean flag."""
+    return value.strip().lower() in ("1", "true", "yes")
+
+
+def env_flag(name):
+    return parse_flag(os.getenv(name, ""))
+
+
+def env_options(**options):
+    """Options whose environment variable is set, parsed with its type.
+
+    Each keyword maps an option name to a (variable, parser) pair.
+    """
+    return {
+        option: parse(os.environ[name])
+        for option, (name, parse) in options.items()
+        if os.getenv(name)
+    }
+
+
 ##################################################
 #       atlas_id_step   Settings File
 ##################################################
@@ -24,8 +46,32 @@ DB_CONFIG = {
         "PORT": int(os.getenv("MONGO_PORT", 27017)),
         "DATABASE": os.getenv("MONGO_NAME", None),
     },
+    "QUERY": {
+        "CHUNK_SIZE": int(os.getenv("QUERY_CHUNK_SIZE", 0)) or None,
+        "MAX_WORKERS": int(os.getenv("QUERY_MAX_WORKERS", 0)) or None,
+        "UNNEST_THRESHOLD": int(os.getenv("QUERY_UNNEST_THRESHOLD", 0))
+        or None,
+    },
 }
 
+# Connection pools use the library defaults unless some setting is given
+POOL_CONFIG = {
+    "PSQL": env_options(
+        pool_size=("PSQL_POOL_SIZE", int),
+        max_overflow=("PSQL_MAX_OVERFLOW", int),
+        pool_timeout=("PSQL_POOL_TIMEOUT", int),
+        pool_pre_ping=("PSQL_POOL_PRE_PING", parse_flag),
+    ),
+    "MONGO": env_options(
+        maxPoolSize=("MONGO_MAX_POOL_SIZE", int),
+        minPoolSize=("MONGO_MIN_POOL_SIZE", int),
+        waitQueueTimeoutMS=("MONGO_WAIT_QUEUE_TIMEOUT_MS", int),
+    ),
+    "WARM_UP": env_flag("POOL_WARM_UP"),
+}
+if any(POOL_CONFIG.values()):
+    DB_CONFIG["POOL"] = POOL_CONFIG
+
 
 # Consumer configuration
 # Each consumer has different parameters and can be found in the documentation
@@ -143,6 +189,15 @@ if os.getenv("KAFKA_USERNAME") and os.getenv("KAFKA_PASSWORD"):
         "KAFKA_PASSWORD"
     )
 
+# Write-behind of detections and non detections (disabled by default)
+WRITE_BEHIND_CONFIG = None
+if env_flag("WRITE_BEHIND"):
+    WRITE_BEHIND_CONFIG = {
+        "MAX_ROWS": int(os.getenv("WRITE_BEHIND_MAX_ROWS", 10000)),
+        "MAX_AGE": float(os.getenv("WRITE_BEHIND_MAX_AGE", 5)),
+        "QUEUE_SIZE": int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", 100)),
+    }
+
 # Step Configuration
 STEP_CONFIG = {
     # "N_PROCESS": 4,            # Number of process for multiprocess script
@@ -153,4 +208,17 @@ STEP_CONFIG = {
     "N_PROCESS": os.getenv("N_PROCESS"),
     "STEP_METADATA": STEP_METADATA,
     "METRICS_CONFIG": METRICS_CONFIG,
+    "CONCURRENT_EXECUTION": env_flag("CONCURRENT_EXECUTION"),
+    "ASYNC_EXECUTION": env_flag("ASYNC_EXECUTION"),
+    "PSQL_PREFETCH_WORKERS": int(os.getenv("PSQL_PREFETCH_WORKERS", 0))
+    or None,
+    "UNIQUE_AID_MESSAGES": env_flag("UNIQUE_AID_MESSAGES"),
+    "CATEGORICAL_IDS": env_flag("CATEGORICAL_IDS"),
+    "INCREMENTAL_MAGSTATS": env_flag("INCREMENTAL_MAGSTATS"),
+    "INCREMENTAL_OBJECT_STATS": env_flag("INCREMENTAL_OBJECT_STATS"),
+    "PRV_CANDIDATES_CACHE_SIZE": int(
+        os.getenv("PRV_CANDIDATES_CACHE_SIZE", 0)
+    ),
+    "MONGO_BATCH_SIZE": int(os.getenv("MONGO_BATCH_SIZE", 0)) or None,
+    "WRITE_BEHIND": WRITE_BEHIND_CONFIG,
 }
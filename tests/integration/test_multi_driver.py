@@ -41,14 +41,18 @@ class MultiDriverTest(unittest.TestCase):
     def test_bulk_insert_objects_mongo(self):
         objects = generate_random_objects(self.n_insert_objects_mongo)
         self.driver.query("Object", engine="mongo").bulk_insert(objects)
-        mongo_objects = self.driver.query("Object", engine="mongo").find_all(paginate=False)
+        mongo_objects = self.driver.query("Object", engine="mongo").find_all(
+            paginate=False
+        )
         self.assertIsInstance(mongo_objects, list)
         self.assertEqual(len(mongo_objects), self.n_insert_objects_mongo)
 
     def test_bulk_insert_detections_mongo(self):
         batch = generate_random_detections(self.n_insert_detections_mongo)
         self.driver.query("Detection", engine="mongo").bulk_insert(batch)
-        mongo_detections = self.driver.query("Detection", engine="mongo").find_all(paginate=False)
+        mongo_detections = self.driver.query(
+            "Detection", engine="mongo"
+        ).find_all(paginate=False)
         self.assertIsInstance(mongo_detections, list)
         self.assertEqual(len(mongo_detections), self.n_insert_detections_mongo)
 
@@ -60,19 +64,27 @@ class MultiDriverTest(unittest.TestCase):
             obj["oid"] = f"{obj['oid']}UPDATED"
             updated.append(obj["oid"])
         filter_by = [{"_id": f"ALERCE{x}"} for x in range(0, 10)]
-        self.driver.query("Object", engine="mongo").bulk_update(objects, filter_by)
+        self.driver.query("Object", engine="mongo").bulk_update(
+            objects, filter_by
+        )
         filter_by = {"oid": {"$in": updated}}
-        updated_objects = self.driver.query("Object", engine="mongo").find_all(filter_by=filter_by, paginate=False)
+        updated_objects = self.driver.query("Object", engine="mongo").find_all(
+            filter_by=filter_by, paginate=False
+        )
         self.assertEqual(len(updated_objects), len(updated))
 
     def test_find_all_objects_mongo(self):
-        mongo_objects = self.driver.query("Object", engine="mongo").find_all(paginate=False)
+        mongo_objects = self.driver.query("Object", engine="mongo").find_all(
+            paginate=False
+        )
         self.assertIsInstance(mongo_objects, list)
         self.assertEqual(len(mongo_objects), self.n_insert_objects_mongo)
 
     def test_find_all_objects_with_filters_mongo(self):
         filter_by = {"aid": {"$in": ["ALERCE1", "ALERCE2"]}}
-        mongo_objects = self.driver.query("Object", engine="mongo").find_all(filter_by=filter_by, paginate=False)
+        mongo_objects = self.driver.query("Object", engine="mongo").find_all(
+            filter_by=filter_by, paginate=False
+        )
         self.assertIsInstance(mongo_objects, list)
         self.assertEqual(len(mongo_objects), 2)
 
@@ -96,11 +108,15 @@ class MultiDriverTest(unittest.TestCase):
         self.driver.query("Object", engine="psql").bulk_update(data, filter_by)
 
     def test_find_all_psql(self):
-        psql_objects = self.driver.query("Object", engine="psql").find_all(paginate=False)
+        psql_objects = self.driver.query("Object", engine="psql").find_all(
+            paginate=False
+        )
         self.assertIsInstance(psql_objects, list)
         self.assertEqual(len(psql_objects), 100)
 
         filter_by = {"aid": {"$in": ["EX0", "EX1"]}}
-        psql_objects = self.driver.query("Object", engine="psql").find_all(filter_by=filter_by, paginate=False)
+        psql_objects = self.driver.query("Object", engine="psql").find_all(
+            filter_by=filter_by, paginate=False
+        )
         self.assertIsInstance(psql_objects, list)
         self.assertEqual(len(psql_objects), 2)
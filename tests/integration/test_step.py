@@ -9,7 +9,6 @@ from tests.unittest.data.messages import generate_alerts_batch
 from typing import List
 from schema import SCHEMA
 
-
 DB_CONFIG = {
     "PSQL": {
         "ENGINE": "postgresql",
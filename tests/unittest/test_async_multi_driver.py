@@ -0,0 +1,182 @@
+import asyncio
+import unittest
+import numpy as np
+import pandas as pd
+
+from unittest import mock
+from ingestion_step.utils.multi_driver import async_connection
+from ingestion_step.utils.multi_driver.async_connection import (
+    AsyncMultiQuery,
+    filter_to_asyncpg,
+)
+from db_plugins.db.sql.models import Object
+from data.messages import generate_random_objects
+
+
+def returning(value):
+    async def coroutine(*args, **kwargs):
+        return value
+
+    return coroutine
+
+
+class AsyncCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    def batch_size(self, size):
+        return self
+
+    def __aiter__(self):
+        self._documents = iter(self.documents)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._documents)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncMultiDriverTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.psql_pool = mock.Mock()
+        self.mongo_database = mock.MagicMock()
+        self.collection = self.mongo_database.__getitem__.return_value
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_query(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_filter_to_asyncpg(self):
+        filter_by = {"aid": {"$in": ["ZTF1", "ZTF2"]}, "fid": 1}
+        where_clause, arguments = filter_to_asyncpg(Object, filter_by)
+        self.assertEqual(where_clause, '"oid" = ANY($1) AND "fid" = $2')
+        self.assertListEqual(arguments, [["ZTF1", "ZTF2"], 1])
+
+    def test_find_dataframe_psql(self):
+        self.psql_pool.fetch.side_effect = returning([("ZTF1", 1)])
+        query = AsyncMultiQuery(
+            self.psql_pool, self.mongo_database, "Detection", engine="psql"
+        )
+        response = self.run_query(
+            query.find_dataframe(
+                {"aid": {"$in": ["ZTF1"]}}, columns=["oid", "candid"]
+            )
+        )
+        self.assertListEqual(list(response.columns), ["oid", "candid"])
+        self.assertEqual(len(response), 1)
+        name, args, kwargs = self.psql_pool.fetch.mock_calls[0]
+        self.assertEqual(
+            args[0],
+            'SELECT "oid", "candid" FROM "detection" WHERE "oid" = ANY($1)',
+        )
+        self.assertListEqual(args[1], ["ZTF1"])
+
+    def test_find_dataframe_mongo(self):
+        self.collection.find.return_value = AsyncCursor(
+            [{"aid": "AL1", "mjd": 59000.0}, {"aid": "AL2"}]
+        )
+        query = AsyncMultiQuery(
+            self.psql_pool, self.mongo_database, "Detection"
+        )
+        response = self.run_query(
+            query.find_dataframe(
+                {"aid": {"$in": ["AL1", "AL2"]}}, columns=["aid", "mjd"]
+            )
+        )
+        name, args, kwargs = self.collection.find.mock_calls[0]
+        self.assertDictEqual(args[1], {"aid": 1, "mjd": 1, "_id": 0})
+        self.assertListEqual(list(response["aid"]), ["AL1", "AL2"])
+        self.assertTrue(np.isnan(response["mjd"][1]))
+
+    def test_bulk_insert_psql(self):
+        self.psql_pool.executemany.side_effect = returning(None)
+        query = AsyncMultiQuery(
+            self.psql_pool, self.mongo_database, "Object", engine="psql"
+        )
+        self.run_query(
+            query.bulk_insert([{"oid": "ZTF1", "ndet": 1, "new": True}])
+        )
+        name, args, kwargs = self.psql_pool.executemany.mock_calls[0]
+        self.assertEqual(
+            args[0], 'INSERT INTO "object" ("oid", "ndet") VALUES ($1, $2)'
+        )
+        self.assertListEqual(args[1], [("ZTF1", 1)])
+
+    def test_bulk_update_psql(self):
+        self.psql_pool.executemany.side_effect = returning(None)
+        query = AsyncMultiQuery(
+            self.psql_pool, self.mongo_database, "Object", engine="psql"
+        )
+        self.run_query(
+            query.bulk_update(
+                [{"oid": "ZTF1", "ndet": 2}], filter_by=[{"_id": "ZTF1"}]
+            )
+        )
+        name, args, kwargs = self.psql_pool.executemany.mock_calls[0]
+        self.assertEqual(
+            args[0],
+            'UPDATE "object" SET "oid" = $1, "ndet" = $2 WHERE "oid" = $1',
+        )
+
+    def test_bulk_upsert_mongo(self):
+        self.collection.bulk_write.side_effect = returning(None)
+        query = AsyncMultiQuery(self.psql_pool, self.mongo_database, "Object")
+        self.run_query(
+            query.bulk_upsert(
+                generate_random_objects(1), filter_by=[{"_id": "ALERCE0"}]
+            )
+        )
+        name, args, kwargs = self.collection.bulk_write.mock_calls[0]
+        self.assertEqual(len(args[0]), 1)
+        self.assertFalse(kwargs["ordered"])
+        self.assertIn("loc", args[0][0]._doc["$set"])
+
+    def test_bulk_upsert_psql_not_implemented(self):
+        query = AsyncMultiQuery(
+            self.psql_pool, self.mongo_database, "Object", engine="psql"
+        )
+        with self.assertRaises(NotImplementedError):
+            self.run_query(query.bulk_upsert([], []))
+
+    @mock.patch.object(async_connection, "AsyncIOMotorClient")
+    @mock.patch.object(async_connection, "asyncpg")
+    def test_connect(self, asyncpg: mock.Mock, motor_client: mock.Mock):
+        asyncpg.create_pool.side_effect = returning(self.psql_pool)
+        self.psql_pool.close.side_effect = returning(None)
+        config = {
+            "PSQL": {
+                "SQLALCHEMY_DATABASE_URL": "postgresql+psycopg2://u:p@h:1/db"
+            },
+            "MONGO": {
+                "HOST": "localhost",
+                "USER": "user",
+                "PASSWORD": "password",
+                "PORT": 27017,
+                "DATABASE": "db",
+                "AUTH_SOURCE": "admin",
+            },
+            "POOL": {"PSQL": {"pool_size": 4, "max_overflow": 2}},
+        }
+        driver = async_connection.AsyncMultiDriverConnection(config)
+        self.run_query(driver.connect())
+        name, args, kwargs = asyncpg.create_pool.mock_calls[0]
+        self.assertEqual(kwargs["dsn"], "postgresql://u:p@h:1/db")
+        self.assertEqual(kwargs["min_size"], 1)
+        self.assertEqual(kwargs["max_size"], 6)
+        name, args, kwargs = motor_client.mock_calls[0]
+        self.assertEqual(kwargs["authSource"], "admin")
+        self.assertEqual(kwargs["username"], "user")
+        self.assertNotIn("DATABASE", kwargs)
+        self.run_query(driver.close())
+        motor_client.return_value.close.assert_called_once()
+        self.assertIsNone(driver.psql_pool)
+
+    @mock.patch.object(async_connection, "asyncpg", None)
+    def test_connection_without_async_drivers(self):
+        with self.assertRaises(ImportError):
+            async_connection.AsyncMultiDriverConnection({})
@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from lc_correction.compute import correction
+from ingestion_step.utils.correction.strategies import ZTFCorrectionStrategy
+from ingestion_step.utils.correction.strategies.ztf_correction_strategy import (
+    correction_array,
+)
+
+
+class ZTFCorrectionTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(42)
+        n = 200
+        self.magnr = rng.uniform(12, 22, n)
+        self.magpsf = rng.uniform(14, 21, n)
+        self.sigmagnr = rng.uniform(0.01, 0.5, n)
+        self.sigmapsf = rng.uniform(0.01, 0.3, n)
+        self.isdiffpos = rng.choice([-1, 1], n)
+        self.magpsf[0] = -1
+        self.distnr = rng.uniform(0, 3, n)
+
+    def test_correction_array(self):
+        response = correction_array(
+            self.magnr,
+            self.magpsf,
+            self.sigmagnr,
+            self.sigmapsf,
+            self.isdiffpos,
+        )
+        expected = np.array(
+            [
+                correction(*args)
+                for args in zip(
+                    self.magnr,
+                    self.magpsf,
+                    self.sigmagnr,
+                    self.sigmapsf,
+                    self.isdiffpos,
+                )
+            ],
+            dtype=float,
+        )
+        for i, values in enumerate(response):
+            np.testing.assert_allclose(values, expected[:, i], rtol=1e-12)
+
+    def test_do_correction(self):
+        n = len(self.magnr)
+        detections = pd.DataFrame(
+            {
+                "candid": np.arange(n),
+                "oid": ["ZTF1", "ZTF2"] * (n // 2),
+                "fid": [1] * n,
+                "mag": self.magpsf,
+                "e_mag": self.sigmapsf,
+                "isdiffpos": self.isdiffpos,
+                "extra_fields": [
+                    {"distnr": d, "magnr": m, "sigmagnr": s}
+                    for d, m, s in zip(self.distnr, self.magnr, self.sigmagnr)
+                ],
+            }
+        )
+        response = ZTFCorrectionStrategy().do_correction(detections)
+        self.assertListEqual(
+            response["corrected"].tolist(), (self.distnr < 1.4).tolist()
+        )
+        for row in response.itertuples():
+            extra_fields = row.extra_fields
+            if row.corrected:
+                expected = correction(
+                    extra_fields["magnr"],
+                    row.mag,
+                    extra_fields["sigmagnr"],
+                    row.e_mag,
+                    row.isdiffpos,
+                )
+                self.assertAlmostEqual(
+                    extra_fields["magpsf_corr"], expected[0]
+                )
+            else:
+                self.assertTrue(np.isnan(extra_fields["magpsf_corr"]))
+            self.assertIn("dubious", extra_fields)
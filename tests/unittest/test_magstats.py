@@ -0,0 +1,121 @@
+import unittest
+import warnings
+import numpy as np
+import pandas as pd
+
+from ingestion_step.utils.constants import MAGSTATS_TRANSLATE
+from ingestion_step.utils.old_preprocess import magstats_df, reuse_magstats
+from lc_correction.compute import apply_mag_stats
+
+
+def random_detections(n=500, seed=0):
+    random = np.random.RandomState(seed)
+    return pd.DataFrame(
+        {
+            "oid": random.choice([f"ZTF{i}" for i in range(50)], n),
+            "fid": random.choice([1, 2], n),
+            # Rounded to have detections with the same mjd
+            "mjd": np.round(random.uniform(59000, 59010, n), 1),
+            "corrected": random.choice([True, False], n),
+            "distnr": random.choice([0.5, 2.0, np.nan, -1.0], n),
+            "distpsnr1": random.choice([0.5, 2.0, np.nan], n),
+            "sgscore1": random.uniform(0, 1, n),
+            "chinr": random.uniform(0, 3, n),
+            "sharpnr": random.uniform(-0.2, 0.2, n),
+            "dubious": random.choice([True, False, None], n),
+            "rfid": random.choice([1.0, 2.0, np.nan], n),
+            "magpsf": random.normal(18, 1, n),
+            "sigmapsf": random.uniform(0, 0.2, n),
+            "magpsf_corr": np.where(
+                random.uniform(size=n) < 0.3, np.nan, random.normal(18, 1, n)
+            ),
+            "magap": random.normal(18, 1, n),
+        }
+    )
+
+
+class MagStatsTest(unittest.TestCase):
+    def test_same_as_apply_mag_stats(self):
+        detections = random_detections()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            expected = (
+                detections.groupby(["oid", "fid"], sort=False)
+                .apply(apply_mag_stats)
+                .reset_index()
+            )
+        response = magstats_df(detections)
+        self.assertListEqual(list(response.columns), list(expected.columns))
+        self.assertListEqual(list(response["oid"]), list(expected["oid"]))
+        for column in expected.columns.drop("oid"):
+            np.testing.assert_allclose(
+                response[column].values.astype(float),
+                expected[column].values.astype(float),
+                err_msg=column,
+            )
+
+    def test_empty_detections(self):
+        response = magstats_df(random_detections().iloc[:0])
+        self.assertEqual(len(response), 0)
+        self.assertListEqual(list(response.columns), ["oid", "fid"])
+
+    def test_reuse_magstats(self):
+        detections = random_detections()
+        detections["new"] = False
+        expected = magstats_df(detections)
+        stored = expected.rename(columns=MAGSTATS_TRANSLATE)
+        # A stored row that doesn't match the light curve
+        stored.loc[1, "ndet"] += 1
+        stale = tuple(stored.loc[1, ["oid", "fid"]])
+        # An object whose magstats were never stored
+        stored = stored[stored["oid"] != "ZTF0"]
+        reused, to_compute = reuse_magstats(stored, detections)
+        computed = detections[to_compute]
+        computed = set(zip(computed["oid"], computed["fid"]))
+        self.assertIn(stale, computed)
+        self.assertIn("ZTF0", {oid for oid, _ in computed})
+        reused_keys = set(zip(reused["oid"], reused["fid"]))
+        self.assertEqual(len(reused_keys & computed), 0)
+        self.assertEqual(len(reused_keys | computed), len(expected))
+        reused = reused.set_index(["oid", "fid"])
+        expected = expected.set_index(["oid", "fid"]).loc[reused.index]
+        for column in reused.columns:
+            np.testing.assert_allclose(
+                reused[column].values.astype(float),
+                expected[column].values.astype(float),
+                err_msg=column,
+            )
+
+    def test_merge_magstats(self):
+        detections = random_detections(seed=1)
+        detections["new"] = (
+            np.random.RandomState(1).uniform(size=len(detections)) < 0.2
+        )
+        # Light curves have the stored detections first
+        detections = pd.concat(
+            [detections[~detections["new"]], detections[detections["new"]]],
+            ignore_index=True,
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            stored = magstats_df(detections[~detections["new"]])
+            expected = magstats_df(detections)
+        stored = stored.rename(columns=MAGSTATS_TRANSLATE)
+        merged, to_compute = reuse_magstats(stored, detections)
+        computed = detections[to_compute]
+        # Only (oid, fid) without stored magstats are computed
+        self.assertTrue(computed["new"].all())
+        self.assertEqual(
+            len(merged) + len(computed.groupby(["oid", "fid"])),
+            len(expected),
+        )
+        merged = merged.set_index(["oid", "fid"])
+        expected = expected.set_index(["oid", "fid"]).loc[merged.index]
+        # magap statistics are not stored, so they can't be merged
+        self.assertNotIn("magap_mean", merged.columns)
+        for column in merged.columns:
+            np.testing.assert_allclose(
+                merged[column].values.astype(float),
+                expected[column].values.astype(float),
+                err_msg=column,
+            )
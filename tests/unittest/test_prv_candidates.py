@@ -0,0 +1,38 @@
+import unittest
+import pandas as pd
+
+from ingestion_step.utils.prv_candidates.cache import PrvCandidatesCache
+from ingestion_step.utils.prv_candidates.strategies import (
+    ZTFPrvCandidatesStrategy,
+)
+from data.messages import generate_message_ztf
+
+
+class PrvCandidatesCacheTestCase(unittest.TestCase):
+    def test_update_keeps_max(self):
+        cache = PrvCandidatesCache(10)
+        cache.update(["ZTF1", "ZTF1"], [2459000.5, 2458000.5])
+        self.assertEqual(cache.get("ZTF1"), 2459000.5)
+        cache.update(["ZTF1"], [2458500.5])
+        self.assertEqual(cache.get("ZTF1"), 2459000.5)
+        self.assertIsNone(cache.get("ZTF2"))
+
+    def test_lru_eviction(self):
+        cache = PrvCandidatesCache(2)
+        cache.update(["ZTF1", "ZTF2"], [1, 2])
+        cache.get("ZTF1")
+        cache.update(["ZTF3"], [3])
+        self.assertEqual(len(cache), 2)
+        self.assertIn("ZTF1", cache)
+        self.assertNotIn("ZTF2", cache)
+
+    def test_skip_ingested_prv_candidates(self):
+        alerts = pd.DataFrame(generate_message_ztf(10))
+        alerts = alerts[alerts["tid"] == "ZTF"]
+        cache = PrvCandidatesCache(100)
+        # everything before 2458500 was already ingested
+        cache.update(alerts["oid"].values, [2458500] * len(alerts))
+        strategy = ZTFPrvCandidatesStrategy(cache=cache)
+        detections, non_detections = strategy.process_prv_candidates(alerts)
+        self.assertTrue((detections["mjd"] > 2458500 - 2400000.5).all())
+        self.assertTrue((non_detections["mjd"] > 2458500 - 2400000.5).all())
@@ -1,18 +1,27 @@
+import asyncio
 import unittest
 import pytest
+import numpy as np
 import pandas as pd
 from unittest import mock
 
 from apf.producers import KafkaProducer
 from ingestion_step.utils.multi_driver.connection import MultiDriverConnection
-from ingestion_step.step import IngestionStep
+from ingestion_step.step import (
+    IngestionStep,
+    categorize_ids,
+    isin_rows,
+    restore_ids,
+    select_rows,
+)
+from ingestion_step.utils.constants import DET_KEYS, NON_DET_KEYS, OBJ_KEYS
+from ingestion_step.utils.write_behind import WriteBehindBuffer
 
 from data.messages import (
     generate_message_atlas,
     generate_message_ztf,
 )
 
-
 DB_CONFIG = {
     "PSQL": {
         "ENGINE": "postgresql",
@@ -59,15 +68,19 @@ class StepTestCase(unittest.TestCase):
     def test_get_objects(self):
         oids = ["ZTF1", "ZTF2"]
         self.step.get_objects(oids)
-        self.step.driver.query("Object", engine="mongo").find_all.assert_called_with(
-            filter_by={"aid": {"$in": oids}}, paginate=False
+        self.step.driver.query(
+            "Object", engine="mongo"
+        ).find_dataframe.assert_called_with(
+            filter_by={"aid": {"$in": oids}}, columns=OBJ_KEYS, batch_size=None
         )
 
     def test_get_detections(self):
         oids = [12345, 45678]
         self.step.get_detections(oids, engine="mongo")
-        self.step.driver.query("Detection", engine="mongo").find_all.assert_called_with(
-            filter_by={"aid": {"$in": oids}}, paginate=False
+        self.step.driver.query(
+            "Detection", engine="mongo"
+        ).find_dataframe.assert_called_with(
+            filter_by={"aid": {"$in": oids}}, columns=DET_KEYS, batch_size=None
         )
 
     def test_get_non_detections(self):
@@ -75,10 +88,54 @@ class StepTestCase(unittest.TestCase):
         self.step.get_non_detections(oids)
         self.step.driver.query(
             "NonDetection", engine="mongo"
-        ).find_all.assert_called_with(
+        ).find_dataframe.assert_called_with(
             filter_by={"aid": {"$in": oids}},
-            paginate=False,
+            columns=NON_DET_KEYS,
+            batch_size=None,
+        )
+
+    def test_max_prefetch_workers(self):
+        self.assertEqual(self.step.max_prefetch_workers, 14)
+        config = {
+            **DB_CONFIG,
+            "POOL": {"PSQL": {"pool_size": 4, "max_overflow": 4}},
+            "QUERY": {"CHUNK_SIZE": 100, "MAX_WORKERS": 3},
+        }
+        step = IngestionStep(
+            config={
+                "DB_CONFIG": config,
+                "STEP_METADATA": {
+                    "STEP_ID": "ingestion",
+                    "STEP_NAME": "ingestion",
+                    "STEP_VERSION": "test",
+                    "STEP_COMMENTS": "test version",
+                },
+            },
+            db_connection=mock.create_autospec(MultiDriverConnection),
+            producer=mock.create_autospec(KafkaProducer),
         )
+        # 7 connections left for prefetch reads of 3 chunk workers each
+        self.assertEqual(step.max_prefetch_workers, 2)
+
+    def test_prefetch_psql(self):
+        oids = ["ZTF1", "ZTF2"]
+        prefetched = self.step.prefetch_psql(oids)
+        expected_keys = [
+            "Ss_ztf",
+            "Reference",
+            "Ps1_ztf",
+            "Gaia_ztf",
+            "MagStats",
+            "objects",
+            "detections",
+            "non_detections",
+        ]
+        self.assertListEqual(list(prefetched.keys()), expected_keys)
+        for df in prefetched.values():
+            self.assertIsInstance(df, pd.DataFrame)
+        self.step.driver.query(
+            "Object", engine="psql"
+        ).find_dataframe.assert_called_with(filter_by={"aid": {"$in": oids}})
 
     def test_insert_objects_without_updates(self):
         objects = {
@@ -95,11 +152,15 @@ class StepTestCase(unittest.TestCase):
             "new": [True],
         }
         df_objects = pd.DataFrame(objects)
-        self.step.insert_objects(df_objects, engine="mongo")
-        self.step.driver.query("Object", engine="mongo").bulk_insert.assert_called()
-        self.step.driver.query("Object", engine="mongo").bulk_update.assert_not_called()
+        self.step.insert_objects(df_objects, engine="psql")
+        self.step.driver.query(
+            "Object", engine="psql"
+        ).bulk_insert.assert_called()
+        self.step.driver.query(
+            "Object", engine="psql"
+        ).bulk_update.assert_not_called()
         insert_call = self.step.driver.query(
-            "Object", engine="mongo"
+            "Object", engine="psql"
         ).bulk_insert.mock_calls[0]
         name, args, kwargs = insert_call
         self.assertIsInstance(args, tuple)
@@ -119,10 +180,32 @@ class StepTestCase(unittest.TestCase):
             "new": [False],
         }
         df_objects = pd.DataFrame(objects)
-        self.step.insert_objects(df_objects)
+        self.step.insert_objects(df_objects, engine="psql")
         self.step.driver.query().bulk_insert.assert_not_called()
         self.step.driver.query().bulk_update.assert_called()
 
+    def test_insert_objects_mongo(self):
+        objects = {
+            "aid": [12345, 12345, 67890],
+            "oid": [["ZTF1"], ["ZTF1"], ["ZTF2"]],
+            "firstmjd": [53000, 53000, 53000],
+            "lastmjd": [54000, 54000, 54000],
+            "ndet": [2, 2, 1],
+            "meanra": [20.0, 20.0, 30.0],
+            "meandec": [30.0, 30.0, 40.0],
+        }
+        df_objects = pd.DataFrame(objects)
+        self.step.insert_objects(df_objects)
+        self.step.driver.query().bulk_insert.assert_not_called()
+        self.step.driver.query().bulk_update.assert_not_called()
+        name, args, kwargs = self.step.driver.query(
+            "Object", engine="mongo"
+        ).bulk_upsert.mock_calls[0]
+        self.assertEqual(len(args[0]), 2)
+        self.assertListEqual(
+            kwargs["filter_by"], [{"_id": 12345}, {"_id": 67890}]
+        )
+
     def test_insert_detections(self):
         detection = {
             "tid": ["test"],
@@ -153,6 +236,14 @@ class StepTestCase(unittest.TestCase):
         self.step.insert_detections(df_detection)
         self.step.driver.query().bulk_insert.assert_called()
 
+    def test_insert_detections_psql(self):
+        detections = pd.DataFrame({"oid": ["ZTF1"], "candid": [1]})
+        self.step.insert_detections(detections, engine="psql")
+        self.step.driver.query().bulk_insert.assert_not_called()
+        self.step.driver.query().bulk_copy.assert_called_with(
+            detections, staging=True
+        )
+
     def test_insert_non_detections(self):
         non_detection = {
             "tid": ["test"],
@@ -188,35 +279,371 @@ class StepTestCase(unittest.TestCase):
         with pytest.raises(ValueError):
             mean_dec, _ = self.step.compute_meandec(df["dec"], df["e_dec"])
 
+    def test_compute_objects_stats(self):
+        detections = pd.DataFrame(
+            {
+                "aid": ["b", "a", "b", "a", "b"],
+                "tid": ["ZTF", "ZTF", "ATLAS", "ZTF", "ZTF"],
+                "oid": ["ZTF2", "ZTF1", "ATLAS2", "ZTF1", "ZTF2"],
+                "ra": [10.0, 20.0, 10.1, 20.2, 10.2],
+                "dec": [-5.0, 5.0, -5.1, 5.2, -5.2],
+                "e_ra": [0.1, 0.2, 0.1, 0.3, 0.2],
+                "e_dec": [0.1, 0.2, 0.1, 0.3, 0.2],
+                "mjd": [59000.0, 59001.0, 59002.0, 58999.0, 58998.0],
+            }
+        )
+        objects = self.step.compute_objects_stats(detections)
+        self.assertListEqual(objects["aid"].tolist(), ["a", "b"])
+        for _, obj in objects.iterrows():
+            dets = detections[detections["aid"] == obj["aid"]]
+            mean_ra, e_ra = self.step.compute_meanra(dets["ra"], dets["e_ra"])
+            mean_dec, e_dec = self.step.compute_meandec(
+                dets["dec"], dets["e_dec"]
+            )
+            self.assertAlmostEqual(obj["meanra"], mean_ra)
+            self.assertAlmostEqual(obj["e_ra"], e_ra)
+            self.assertAlmostEqual(obj["meandec"], mean_dec)
+            self.assertAlmostEqual(obj["e_dec"], e_dec)
+            self.assertEqual(obj["firstmjd"], dets["mjd"].min())
+            self.assertEqual(obj["lastmjd"], dets["mjd"].max())
+            self.assertEqual(obj["ndet"], len(dets))
+            self.assertListEqual(obj["tid"], list(dets["tid"].unique()))
+            self.assertListEqual(obj["oid"], list(dets["oid"].unique()))
+
+    def test_compute_objects_stats_incorrect(self):
+        detections = pd.DataFrame(
+            {
+                "aid": ["a", "a"],
+                "tid": ["ZTF", "ZTF"],
+                "oid": ["ZTF1", "ZTF1"],
+                "ra": [-200.0, -100.0],
+                "dec": [5.0, 5.0],
+                "e_ra": [0.1, 0.1],
+                "e_dec": [0.1, 0.1],
+                "mjd": [59000.0, 59001.0],
+            }
+        )
+        with pytest.raises(ValueError):
+            self.step.compute_objects_stats(detections)
+
+    def test_update_objects_stats(self):
+        detections = pd.DataFrame(
+            {
+                "aid": ["a", "a", "b", "a", "b", "c"],
+                "tid": ["ZTF", "ZTF", "ZTF", "ATLAS", "ZTF", "ZTF"],
+                "oid": ["ZTF1", "ZTF1", "ZTF2", "ATLAS1", "ZTF2", "ZTF3"],
+                "ra": [20.0, 20.2, 10.0, 20.1, 10.2, 30.0],
+                "dec": [5.0, 5.2, -5.0, 5.1, -5.2, 1.0],
+                "e_ra": [0.2, 0.3, 0.1, 0.1, 0.2, 0.1],
+                "e_dec": [0.2, 0.3, 0.1, 0.1, 0.2, 0.1],
+                "mjd": [59001.0, 58999.0, 59000.0, 58990.0, 58998.0, 59005.0],
+                "new": [False, False, False, True, True, True],
+            }
+        )
+        stored = self.step.compute_objects_stats(
+            detections[~detections["new"]]
+        )
+        # Stored ndet of "b" doesn't match its light curve
+        stored.loc[stored["aid"] == "b", "ndet"] = 5
+        objects = self.step.update_objects_stats(detections, stored)
+        expected = self.step.compute_objects_stats(detections)
+        self.assertListEqual(objects["aid"].tolist(), ["a", "b", "c"])
+        for column in ["meanra", "e_ra", "meandec", "e_dec", "firstmjd"]:
+            np.testing.assert_allclose(objects[column], expected[column])
+        self.assertListEqual(objects["ndet"].tolist(), [3, 2, 1])
+        self.assertListEqual(objects["tid"][0], ["ZTF", "ATLAS"])
+
+    @mock.patch("db_plugins.db.mongo.MongoConnection.query")
+    def test_update_objects_stats_from_upserted(self, mongo_query):
+        detections = pd.DataFrame(
+            {
+                "aid": ["a", "a", "b", "b"],
+                "tid": ["ZTF", "ATLAS", "ZTF", "ZTF"],
+                "oid": ["ZTF1", "ATLAS1", "ZTF2", "ZTF2"],
+                "ra": [20.0, 20.2, 10.0, 10.2],
+                "dec": [5.0, 5.2, -5.0, -5.2],
+                "e_ra": [0.2, 0.3, 0.1, 0.2],
+                "e_dec": [0.2, 0.3, 0.1, 0.2],
+                "mjd": [59001.0, 58999.0, 59000.0, 59002.0],
+                "new": [False, True, False, True],
+            }
+        )
+        driver = MultiDriverConnection(DB_CONFIG)
+        self.step.driver = driver
+        self.step.insert_objects(
+            self.step.compute_objects_stats(detections[~detections["new"]])
+        )
+        collection = mongo_query.return_value.collection
+        name, args, kwargs = collection.bulk_write.mock_calls[0]
+        # Documents as they are stored by the upserts
+        collection.find.return_value = [
+            {**operation._filter, **operation._doc["$set"]}
+            for operation in args[0]
+        ]
+        stored = self.step.get_stored_objects(["a", "b"])
+        name, args, kwargs = collection.find.mock_calls[0]
+        self.assertDictEqual(args[0], {"_id": {"$in": ["a", "b"]}})
+        self.assertListEqual(stored["aid"].tolist(), ["a", "b"])
+        expected = self.step.compute_objects_stats(detections)
+        with mock.patch.object(
+            self.step,
+            "compute_objects_stats",
+            wraps=self.step.compute_objects_stats,
+        ) as compute:
+            objects = self.step.update_objects_stats(detections, stored)
+        # Both objects are updated from their stored sums
+        name, args, kwargs = compute.mock_calls[0]
+        self.assertEqual(len(args[0]), 0)
+        for column in ["meanra", "e_ra", "meandec", "e_dec", "firstmjd"]:
+            np.testing.assert_allclose(objects[column], expected[column])
+        self.assertListEqual(objects["ndet"].tolist(), [2, 2])
+
+    def test_isin_rows(self):
+        new = pd.DataFrame(
+            {
+                "aid": ["AL1", "AL1", "AL2"],
+                "candid": [1, 2, 1],
+                "fid": [1, 1, 2],
+            }
+        )
+        old = pd.DataFrame(
+            {"aid": ["AL1", "AL2"], "candid": [2.0, 1.0], "fid": [1, 1]}
+        )
+        mask = isin_rows(new, old, ["aid", "candid"])
+        self.assertListEqual(mask.tolist(), [False, True, True])
+        mask = isin_rows(new, old, ["aid", "candid", "fid"])
+        self.assertListEqual(mask.tolist(), [False, True, False])
+        empty = pd.DataFrame(columns=["aid", "candid", "fid"])
+        self.assertFalse(isin_rows(new, empty, ["aid", "candid"]).any())
+
+    def test_categorize_ids(self):
+        alerts = pd.DataFrame({"aid": ["AL1", "AL2"], "fid": [1, 2]})
+        detections = pd.DataFrame({"aid": ["AL1"], "fid": [3]})
+        categorize_ids([alerts, detections])
+        self.assertEqual(alerts["aid"].dtype, "category")
+        self.assertListEqual(list(detections["fid"].cat.categories), [1, 2, 3])
+        restore_ids([alerts, detections])
+        self.assertListEqual(alerts["aid"].tolist(), ["AL1", "AL2"])
+        self.assertListEqual(detections["fid"].tolist(), [3])
+        self.assertNotEqual(detections["fid"].dtype, "category")
+
+    def test_execute_with_categorical_ids(self):
+        self.step.categorical_ids = True
+        ZTF_messages = generate_message_ztf(10)
+        self.step.execute(ZTF_messages)
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 3
+        assert len(self.step.driver.query().bulk_copy.mock_calls) == 3
+
+    def test_select_rows(self):
+        frame = pd.DataFrame({"tid": ["ZTF", "ATLAS", "ZTF"]})
+        self.assertIs(select_rows(frame, frame["tid"] != ""), frame)
+        selected = select_rows(frame, frame["tid"] == "ZTF")
+        self.assertListEqual(selected.index.tolist(), [0, 1])
+        self.assertEqual(len(frame), 3)
+
+    def test_preprocess_lightcurves_keeps_inputs(self):
+        detections = pd.DataFrame(
+            {"aid": ["AL1", "AL1"], "oid": ["ZTF1"] * 2, "candid": [1, 2]}
+        )
+        non_detections = pd.DataFrame(
+            {"aid": ["AL1", "AL1"], "fid": [1, 1], "mjd": [59000.0, 59001.0]}
+        )
+        light_curves = {
+            "detections": detections.iloc[:1].copy(),
+            "non_detections": non_detections.iloc[:1].copy(),
+        }
+        light_curves = self.step.preprocess_lightcurves(
+            detections, non_detections, light_curves=light_curves
+        )
+        self.assertListEqual(
+            light_curves["detections"]["new"].tolist(), [False, True]
+        )
+        self.assertListEqual(
+            light_curves["non_detections"]["new"].tolist(), [False, True]
+        )
+        self.assertNotIn("new", detections.columns)
+        self.assertListEqual(
+            list(non_detections.columns), ["aid", "fid", "mjd"]
+        )
+
     def test_execute_with_ZTF_stream(self):
         ZTF_messages = generate_message_ztf(10)
         self.step.execute(ZTF_messages)
         # Verify 3 inserts calls: objects, detections, non_detections
-        assert len(self.step.driver.query().bulk_insert.mock_calls) == 12
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 3
+        # Verify 3 copy calls: detections, non_detections, dataquality
+        assert len(self.step.driver.query().bulk_copy.mock_calls) == 3
+        self.step.driver.query().bulk_upsert.assert_called()
 
     def test_execute_with_ZTF_stream_non_detections(self):
         ZTF_messages = generate_message_ztf(10)
         self.step.execute(ZTF_messages)
         # Verify 3 inserts calls: objects, detections, non_detections
-        assert len(self.step.driver.query().bulk_insert.mock_calls) == 12
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 3
+        # Verify 3 copy calls: detections, non_detections, dataquality
+        assert len(self.step.driver.query().bulk_copy.mock_calls) == 3
+        self.step.driver.query().bulk_upsert.assert_called()
+
+    def test_execute_concurrently_with_ZTF_stream(self):
+        self.step.concurrent_execution = True
+        ZTF_messages = generate_message_ztf(10)
+        self.step.execute(ZTF_messages)
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 3
+        self.step.producer.produce.assert_called()
+
+    def test_execute_async_with_ZTF_stream(self):
+        async def find_dataframe(filter_by, columns=None, batch_size=None):
+            return pd.DataFrame(columns=columns)
+
+        async def write(*args, **kwargs):
+            return None
+
+        async_driver = mock.Mock()
+        async_driver.query.return_value.find_dataframe.side_effect = (
+            find_dataframe
+        )
+        async_driver.query.return_value.bulk_insert.side_effect = write
+        async_driver.query.return_value.bulk_upsert.side_effect = write
+        self.step.async_execution = True
+        self.step.async_driver = async_driver
+        self.step.loop = asyncio.new_event_loop()
+        ZTF_messages = generate_message_ztf(10)
+        self.step.execute(ZTF_messages)
+        self.step.loop.close()
+        # Mongo light curves and PSQL catalogs are read on the async driver
+        self.step.driver.query().find_dataframe.assert_not_called()
+        # Mongo writes: objects upsert, detections and non detections
+        async_driver.query().bulk_upsert.assert_called_once()
+        self.assertEqual(len(async_driver.query().bulk_insert.mock_calls), 2)
+        # PSQL writes: new objects
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 1
+        self.step.producer.produce.assert_called()
+
+    def test_tear_down_closes_async_driver(self):
+        async def close():
+            return None
+
+        self.step.async_execution = True
+        self.step.async_driver = mock.Mock()
+        self.step.async_driver.close.side_effect = close
+        self.step.loop = asyncio.new_event_loop()
+        self.step.tear_down()
+        self.step.async_driver.close.assert_called_once()
+        self.assertTrue(self.step.loop.is_closed())
+        # A second call does nothing
+        self.step.tear_down()
+        self.step.async_driver.close.assert_called_once()
+
+    def test_execute_with_write_behind(self):
+        self.step.consumer = mock.Mock()
+        self.step.write_buffer = WriteBehindBuffer(
+            self.step.write_buffered, max_age=0
+        )
+        self.step.last_commit = 0
+        ZTF_messages = generate_message_ztf(10)
+        self.step.execute(ZTF_messages)
+        # Buffer is flushed before committing offsets
+        self.step.consumer.commit.assert_called_once()
+        self.assertFalse(self.step.write_buffer.is_pending(["ZTF1"]))
+        # Detections and non detections are written by the buffer
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 3
+        assert len(self.step.driver.query().bulk_copy.mock_calls) == 3
+
+    def test_tear_down_raises_write_error(self):
+        def write(name, data):
+            raise ValueError()
+
+        self.step.consumer = mock.Mock()
+        self.step.write_buffer = WriteBehindBuffer(write, max_rows=1)
+        self.step.write_buffer.put(
+            ("mongo", "Detection"), pd.DataFrame({"aid": ["AL1"]}), ["AL1"]
+        )
+        with self.assertRaises(RuntimeError):
+            self.step.tear_down()
+        # Offsets of rows not written are not committed
+        self.step.consumer.commit.assert_not_called()
 
     def test_execute_with_ATLAS_stream(self):
         ATLAS_messages = generate_message_atlas(10)
         self.step.execute(ATLAS_messages)
-        # Verify 3 inserts calls: objects, detections, non_detections
-        assert len(self.step.driver.query().bulk_insert.mock_calls) == 3
+        # Verify 2 inserts calls: detections, non_detections
+        assert len(self.step.driver.query().bulk_insert.mock_calls) == 2
+        self.step.driver.query().bulk_upsert.assert_called()
 
     def test_produce(self):
-        alerts = pd.DataFrame([{"aid": "a", "oid": "a", "candid": 1, "tid": 1}])
+        alerts = pd.DataFrame(
+            [{"aid": "a", "oid": "a", "candid": 1, "tid": 1}]
+        )
         objects = pd.DataFrame(
-            [{"aid": "a",  "oid": "a", "meanra": 1, "meandec": 1, "ndet": 1, "lastmjd": 1, "tid": "a"}]
+            [
+                {
+                    "aid": "a",
+                    "oid": "a",
+                    "meanra": 1,
+                    "meandec": 1,
+                    "ndet": 1,
+                    "lastmjd": 1,
+                    "tid": "a",
+                }
+            ]
         )
         light_curves = {
-            "detections": pd.DataFrame([{"aid": "a",  "oid": "a", "candid": 1, "new": True, "tid": "a"}]),
+            "detections": pd.DataFrame(
+                [
+                    {
+                        "aid": "a",
+                        "oid": "a",
+                        "candid": 1,
+                        "new": True,
+                        "tid": "a",
+                    }
+                ]
+            ),
             "non_detections": pd.DataFrame(
-                [{"aid": "a",  "oid": "a", "candid": None, "new": False}]
+                [{"aid": "a", "oid": "a", "candid": None, "new": False}]
             ),
         }
-        metadata = pd.DataFrame([{"aid": "a",  "oid": "a", "ps1": {}, "gaia": {}}])
+        metadata = pd.DataFrame(
+            [{"aid": "a", "oid": "a", "ps1": {}, "gaia": {}}]
+        )
         self.step.produce(alerts, objects, light_curves, metadata)
         self.assertEqual(len(self.step.producer.produce.mock_calls), 1)
+
+    def test_produce_unique_aid_messages(self):
+        self.step.unique_aid_messages = True
+        alerts = pd.DataFrame(
+            [
+                {"aid": "a", "oid": "a", "candid": 1, "tid": "a", "mjd": 1},
+                {"aid": "a", "oid": "a", "candid": 2, "tid": "a", "mjd": 2},
+            ]
+        )
+        objects = pd.DataFrame(
+            [
+                {
+                    "aid": "a",
+                    "oid": "a",
+                    "meanra": 1,
+                    "meandec": 1,
+                    "ndet": 2,
+                    "lastmjd": 2,
+                    "tid": "a",
+                }
+            ]
+        )
+        light_curves = {
+            "detections": pd.DataFrame(
+                [
+                    {"aid": "a", "oid": "a", "candid": 1, "new": True},
+                    {"aid": "a", "oid": "a", "candid": 2, "new": True},
+                ]
+            ),
+            "non_detections": pd.DataFrame(
+                [{"aid": "a", "oid": "a", "candid": None, "new": False}]
+            ),
+        }
+        self.step.produce(alerts, objects, light_curves, None)
+        self.assertEqual(len(self.step.producer.produce.mock_calls), 1)
+        name, args, kwargs = self.step.producer.produce.mock_calls[0]
+        message = args[0]
+        self.assertEqual(message["candid"], "2")
+        self.assertEqual(len(message["detections"]), 2)
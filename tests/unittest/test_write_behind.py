@@ -0,0 +1,68 @@
+import time
+import unittest
+import pandas as pd
+
+from ingestion_step.utils.write_behind import WriteBehindBuffer
+
+
+class WriteBehindBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.written = []
+
+    def write(self, name, frame):
+        self.written.append((name, len(frame)))
+
+    def test_flush(self):
+        buffer = WriteBehindBuffer(self.write, max_rows=100, max_age=60)
+        buffer.put("detections", pd.DataFrame({"aid": ["AL1"]}), ["AL1"])
+        buffer.put("detections", pd.DataFrame({"aid": ["AL2"]}), ["AL2"])
+        self.assertTrue(buffer.is_pending(["AL1"]))
+        buffer.flush()
+        # Frames with the same name are written together
+        self.assertListEqual(self.written, [("detections", 2)])
+        self.assertFalse(buffer.is_pending(["AL1", "AL2"]))
+
+    def test_write_by_size(self):
+        buffer = WriteBehindBuffer(self.write, max_rows=2, max_age=60)
+        buffer.put("detections", pd.DataFrame({"aid": ["AL1", "AL2"]}), [])
+        time.sleep(0.1)
+        self.assertListEqual(self.written, [("detections", 2)])
+
+    def test_write_by_age(self):
+        buffer = WriteBehindBuffer(self.write, max_rows=100, max_age=0.05)
+        buffer.put("detections", pd.DataFrame({"aid": ["AL1"]}), ["AL1"])
+        time.sleep(0.2)
+        self.assertListEqual(self.written, [("detections", 1)])
+
+    def test_write_error(self):
+        def write(name, frame):
+            raise ValueError()
+
+        buffer = WriteBehindBuffer(write)
+        buffer.put("detections", pd.DataFrame({"aid": ["AL1"]}), ["AL1"])
+        with self.assertRaises(RuntimeError):
+            buffer.flush()
+        # Rows of a failed write are dropped, they are not pending
+        self.assertFalse(buffer.is_pending(["AL1"]))
+        with self.assertRaises(RuntimeError):
+            buffer.close()
+
+    def test_close(self):
+        buffer = WriteBehindBuffer(self.write, max_rows=100, max_age=60)
+        buffer.put("detections", pd.DataFrame({"aid": ["AL1"]}), ["AL1"])
+        buffer.close()
+        self.assertListEqual(self.written, [("detections", 1)])
+        self.assertFalse(buffer.is_pending(["AL1"]))
+        # Closed buffers don't wait for the writer
+        buffer.close()
+        buffer.flush()
+
+    def test_close_after_write_error(self):
+        def write(name, frame):
+            raise ValueError()
+
+        # The error of the last write is raised, even without a later put
+        buffer = WriteBehindBuffer(write, max_rows=1, max_age=60)
+        buffer.put("detections", pd.DataFrame({"aid": ["AL1"]}), ["AL1"])
+        with self.assertRaises(RuntimeError):
+            buffer.close()